@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+# Benchmarks of git-se over synthetic repositories, offline and headless.
+#
+#   benchmarks/bench.py                      run and compare with benchmarks/baseline.json
+#   benchmarks/bench.py --save-baseline      run and store the results as the new baseline
+#   benchmarks/bench.py --files 500 --hunks 20 --line-length 200 --renames 10 --binaries 5
+#
+# Patch parsing, patch generation, rendering and grouping hunks into proposed stages are timed
+# in-process with curses stubbed out, startup and the per-stage apply/commit/cherry-pick cycle
+# are timed by running git-se.py with a headless --plan in both worktree and --in-memory modes.
+# Cold start is the interpreter loading git-se.py, next to the cost of importing pygit2 alone.
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import pygit2
+from pygit2.enums import DiffOption
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+GIT_SE = os.path.join(BENCH_DIR, "..", "git-se.py")
+BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+STAGES_RE = re.compile(r"^([0-9]+) stages in ([0-9.]+)s", re.M)
+
+
+def load_git_se():
+    spec = importlib.util.spec_from_file_location("git_se", GIT_SE)
+    module = importlib.util.module_from_spec(spec)
+    # the hunk index workers find their function by the module name
+    sys.modules["git_se"] = module
+    spec.loader.exec_module(module)
+    # rendering only needs color pairs, no terminal is set up
+    module.curses.color_pair = lambda n: n << 8
+    return module
+
+
+class StubWindow:
+    # just enough of a curses window for render_box
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.cells = 0
+
+    def getmaxyx(self):
+        return (self.rows, self.cols)
+
+    def addstr(self, y, x, text, attr=0):
+        self.cells += len(text)
+
+
+def make_repo(path, params):
+    # base commit, a commit with all the changes and a small one on top of it, like a branch to split
+    rnd = random.Random(params["seed"])
+    repo = pygit2.init_repository(path)
+    sig = pygit2.Signature("bench", "bench@git-se")
+
+    def line(i, j):
+        word = "f{}l{} ".format(i, j)
+        return (word * (params["line_length"] // len(word) + 1))[:params["line_length"]]
+
+    def commit(files, message):
+        index = pygit2.Index()
+        for name, data in files.items():
+            index.add(pygit2.IndexEntry(name, repo.create_blob(data), pygit2.GIT_FILEMODE_BLOB))
+        parents = [] if repo.head_is_unborn else [repo.head.target]
+        return repo.create_commit("HEAD", sig, sig, message, index.write_tree(repo), parents)
+
+    text = {}
+    for i in range(params["files"]):
+        text["src/f{:04d}.txt".format(i)] = [line(i, j) for j in range(params["lines"])]
+    binaries = {"bin/b{:03d}.dat".format(i): rnd.randbytes(params["binary_size"]) for i in range(params["binaries"])}
+
+    def tree_files():
+        files = {name: ("\n".join(lines) + "\n").encode() for name, lines in text.items()}
+        files.update(binaries)
+        return files
+
+    base = commit(tree_files(), "base")
+
+    step = max(params["lines"] // max(params["hunks"], 1), 8)
+    for i, name in enumerate(sorted(text)):
+        lines = text[name]
+        for h in range(params["hunks"]):
+            j = h * step + step // 2
+            if j >= len(lines):
+                break
+            lines[j] = lines[j][::-1]
+            lines.insert(j + 1, "added " + line(i, j))
+    for name in sorted(text)[:params["renames"]]:
+        text[name.replace("src/", "src/moved/")] = text.pop(name)
+    for name in binaries:
+        binaries[name] = rnd.randbytes(params["binary_size"])
+    commit(tree_files(), "change")
+
+    name = sorted(text)[-1]
+    text[name].append("tail")
+    commit(tree_files(), "tail")
+
+    repo.checkout_head(strategy=pygit2.GIT_CHECKOUT_FORCE)
+    with open(os.path.join(path, ".git", "info", "exclude"), "a") as exclude:
+        exclude.write(".git-se\n")
+    return (repo, str(base))
+
+
+def best(repeat, fn):
+    times = []
+    for r in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return min(times)
+
+
+def bench_patches(gitse, repo, base, repeat):
+    logger = logging.getLogger("bench")
+    results = {}
+    head = repo.revparse_single("HEAD")
+
+    def diff():
+        d = repo.diff(base, head, flags=DiffOption.SHOW_BINARY)
+        return [p for p in d if not p.delta.is_binary]
+
+    results["diff"] = best(repeat, lambda: [p.data for p in diff()])
+    patches = diff()
+
+    rows = []
+    results["navigation map"] = best(repeat, lambda: rows.__setitem__(slice(None), [gitse.PatchLines(repo, p, logger) for p in patches]))
+
+    selections = []
+    for lines in rows:
+        selected = bytearray(len(lines))
+        for row in lines.nav_map[::2]:
+            selected[row] = 1
+        selections.append(selected)
+
+    def generate():
+        for lines, selected in zip(rows, selections):
+            gitse.generate_patch(lines, selected, lines.line_desc, logger)
+    results["generate patch"] = best(repeat, generate)
+
+    def render():
+        box = StubWindow(50, 160)
+        for lines, selected in zip(rows, selections):
+            for offset in range(0, len(lines), 48):
+                gitse.render_box(box, lines, lines.line_desc, offset, offset, selected)
+    results["render"] = best(repeat, render)
+
+    def hunk_index():
+        index = gitse.HunkIndex(repo.path, list(diff_all.deltas), base)
+        index.done.wait()
+        if index.error:
+            raise index.error
+    diff_all = gitse.stage_diff(repo, repo.revparse_single(base).id, head.id)
+    results["hunk index"] = best(repeat, hunk_index)
+    return results
+
+
+def run_git_se(path, base, plan, extra):
+    with open(os.path.join(path, "plan.json"), "w") as f:
+        json.dump(plan, f)
+    started = time.perf_counter()
+    out = subprocess.run([sys.executable, GIT_SE, base, "-r", path, "--plan", os.path.join(path, "plan.json"),
+                          "--ai-backend", "local", "--no-ai-cache"] + extra,
+                         cwd=path, capture_output=True, text=True)
+    wall = time.perf_counter() - started
+    if out.returncode != 0:
+        raise RuntimeError("git-se failed: {}".format(out.stderr))
+    m = STAGES_RE.search(out.stdout)
+    return (wall, int(m.group(1)), float(m.group(2)))
+
+
+def split_plan(repo, base, stages):
+    # first stage takes the first hunk of every modified file and only the new side of the moved files,
+    # their deletions stay with the remaining changes. Then groups of whole files
+    d = repo.diff(base, repo.revparse_single("HEAD"), flags=DiffOption.SHOW_BINARY)
+    patches = sorted(d, key=lambda p: p.delta.new_file.path)
+    size = max(len(patches) // max(stages - 1, 1), 1)
+    modified = [p.delta.new_file.path for p in patches
+                if p.delta.status == pygit2.GIT_DELTA_MODIFIED and not p.delta.is_binary and len(p.hunks) > 1]
+    moved = [p.delta.new_file.path for p in patches if p.delta.status == pygit2.GIT_DELTA_ADDED]
+    plan = []
+    if modified or moved:
+        plan.append({"message": "partial", "files": moved, "hunks": {p: [1] for p in modified}})
+    rest = [p.delta.new_file.path for p in patches if p.delta.status != pygit2.GIT_DELTA_ADDED]
+    for n in range(stages - 2):
+        files = rest[n * size:(n + 1) * size]
+        if files:
+            plan.append({"message": "group {}".format(n + 1), "files": files})
+    plan.append({"message": "rest", "files": ["*"]})
+    return plan
+
+
+def bench_cold_start(repeat):
+    results = {}
+    results["import pygit2"] = best(repeat, lambda: subprocess.run([sys.executable, "-c", "import pygit2"], check=True))
+    results["cold start"] = best(repeat, lambda: subprocess.run([sys.executable, GIT_SE, "--help"], check=True, stdout=subprocess.DEVNULL))
+    return results
+
+
+def bench_sessions(repo, path, base, stages, repeat):
+    results = {}
+    plan = split_plan(repo, base, stages)
+    for mode, extra in (("worktree", []), ("in-memory", ["--in-memory"])):
+        results["startup " + mode] = best(repeat, lambda: run_git_se(path, base, [], extra))
+        per_stage = []
+        for r in range(repeat):
+            wall, done, seconds = run_git_se(path, base, plan, extra)
+            per_stage.append(seconds / max(done, 1))
+        results["stage " + mode] = min(per_stage)
+    return results
+
+
+def compare(results, params, baseline, tolerance):
+    # returns names of the benchmarks which got slower than the baseline allows
+    slower = []
+    known = baseline.get("results", {}) if baseline.get("params") == params else {}
+    if baseline and not known:
+        print("baseline was taken with other parameters, not comparing")
+    print("{:<20} {:>10} {:>10} {:>8}".format("benchmark", "seconds", "baseline", "ratio"))
+    for name, value in results.items():
+        if name in known:
+            ratio = value / known[name] if known[name] else 1.0
+            mark = " slower" if ratio > 1 + tolerance else ""
+            if mark:
+                slower.append(name)
+            print("{:<20} {:>10.4f} {:>10.4f} {:>8.2f}{}".format(name, value, known[name], ratio, mark))
+        else:
+            print("{:<20} {:>10.4f}".format(name, value))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='git-se benchmarks over synthetic repositories')
+    parser.add_argument('--files', type=int, default=200, help='text files changed in the range')
+    parser.add_argument('--lines', type=int, default=400, help='lines per text file')
+    parser.add_argument('--hunks', type=int, default=8, help='hunks per text file')
+    parser.add_argument('--line-length', type=int, default=80, help='characters per line')
+    parser.add_argument('--renames', type=int, default=10, help='text files moved to another directory')
+    parser.add_argument('--binaries', type=int, default=5, help='changed binary files')
+    parser.add_argument('--binary-size', type=int, default=4096, help='bytes per binary file')
+    parser.add_argument('--stages', type=int, default=4, help='stages of the headless plan')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5, help='runs per benchmark, the best one counts')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline results to compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed slowdown against the baseline')
+    parser.add_argument('--keep', action='store_true', help='keep the generated repository')
+    args = parser.parse_args()
+
+    params = {k: getattr(args, k) for k in ("files", "lines", "hunks", "line_length", "renames", "binaries", "binary_size", "stages", "seed")}
+    path = tempfile.mkdtemp(prefix="git-se-bench-")
+    try:
+        gitse = load_git_se()
+        started = time.perf_counter()
+        repo, base = make_repo(path, params)
+        print("repository with {} files generated in {:.2f}s at {}".format(args.files + args.binaries, time.perf_counter() - started, path))
+
+        results = bench_patches(gitse, repo, base, args.repeat)
+        results.update(bench_sessions(repo, path, base, args.stages, args.repeat))
+        results.update(bench_cold_start(args.repeat))
+    finally:
+        if not args.keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+    slower = compare(results, params, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"params": params, "results": results}, f, indent=2)
+            f.write("\n")
+        print("baseline saved to {}".format(args.baseline))
+    elif slower:
+        print("slower than the baseline: {}".format(", ".join(slower)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
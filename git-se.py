@@ -9,289 +9,735 @@ from pygit2.enums import DiffOption
 from pygit2.enums import ApplyLocation
 from pygit2.enums import DiffStatsFormat
 from pygit2.enums import DeltaStatus
+from pygit2.enums import MergeFavor
+from pygit2.enums import DiffFind
+from pygit2.enums import SortMode
 import logging
 from dataclasses import dataclass
-from enum import Enum
+from enum import IntEnum
+from array import array
 import subprocess
 import pathlib
-from openai import OpenAI
+import shutil
 import json
 import textwrap
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import hashlib
+import os
+import sys
+import time
+import fnmatch
+import bisect
+import contextlib
+import fcntl
+import itertools
 
 SE_DIR = ".git-se"
 WORK_DIR = None
 ai_chapter = 1
 ai_file = None
 recreator_file = None
-oai = None
+replay_file = None
+REPLAY_FILENAME = "git-se.recreator.fi"
+REPLAY_REF = None
+ai_backend = None
+ai_cache = None
 OAI_MODEL = "gpt-3.5-turbo"
 AI_PROMPT_FILENAME = "ai-prompt.txt"
-
-class LineType(Enum):
+AI_SYSTEM_PROMPT = "You are helpful code reviewer. You explain patches and diffs in great depth using simple terms. You replace the word `patch` with a word `changeset`. You do not include the patch into the answer. You provide only generated description."
+AI_TOKEN_BUDGET = 12000
+AI_WORKERS = 4
+AI_CACHE_DIR = "ai-cache"
+AI_CACHE_MAX_BYTES = 64 * 1024 * 1024
+AI_CACHE_MAX_AGE = 30 * 24 * 3600
+IN_MEMORY = False
+SE_REF = None
+TRACE_LINES = False
+FIND_RENAMES = None  # similarity threshold in percent, None keeps renames as a delete and an add
+FIND_COPIES = None
+RENAME_LIMIT = 1000
+PROFILE_FILENAME = "git-se.profile.jsonl"
+profiler = None
+JOURNAL_FILENAME = "journal.jsonl"
+journal = None
+PER_COMMIT = False
+commit_seeds = None
+SESSIONS_DIR = "sessions"   # named sessions keep their state, logs and worktree apart from each other
+SESSION_WORKTREE = "worktree"
+SESSION_NAME_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*$")
+HUNK_INDEX_WORKERS = min(os.cpu_count() or 1, 8)  # processes reading the hunks of stage proposals
+HUNK_INDEX_CHUNK = 16       # files per task of a worker
+PROPOSAL_MAX_HUNKS = 40     # proposed stages do not grow over this
+PROPOSAL_RARE_TOKEN = 8     # identifiers changed in more hunks than this, or a tenth of them, do not relate them
+PROPOSAL_NEAR_LINES = 10    # hunks of a file closer than this go together
+COCHANGE_COMMITS = 200      # history walked for files which used to change together
+COCHANGE_MAX_FILES = 30     # bigger commits say nothing about related files
+IDENTIFIER_RE = re.compile(rb"[A-Za-z_][A-Za-z0-9_]{3,}")
+WORD_RE = re.compile(rb"\w+")
+PARTIAL_STATUSES = (DeltaStatus.MODIFIED, DeltaStatus.ADDED, DeltaStatus.RENAMED, DeltaStatus.COPIED)
+NULL_OID = pygit2.Oid(raw=bytes(20))
+PATCH_WINDOW = 256   # rows of a patch decoded at once
+PATCH_WINDOWS = 16   # decoded windows kept per patch
+# control characters and undecodable bytes of patch lines as they are shown
+DISPLAY_CHARS = {c: "?" for c in list(range(0x20)) + [0x7f] if c != 0x09}
+DISPLAY_CHARS[0x0d] = None
+DISPLAY_CHARS.update({c: "\ufffd" for c in range(0xdc80, 0xdd00)})
+HUNK_HEADER_RE = re.compile(r"@@\s*\-([0-9]+)(?:,([0-9]+))?\s+\+([0-9]+)(?:,([0-9]+))?\s*@@\s*(.*)")
+
+class Profiler:
+    # wall time and retained memory blocks per phase, written as one JSON object per stage.
+    # Retained blocks are the net change of the allocated blocks: what a phase keeps, less what it frees,
+    # and negative when it frees more. The AI and hunk index threads running alongside are counted in too
+    def __init__(self, path):
+        self.file = open(path, "w")
+        self.lock = threading.Lock()
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        retained = sys.getallocatedblocks()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - started
+            retained = sys.getallocatedblocks() - retained
+            with self.lock:
+                p = self.phases.setdefault(name, {"calls": 0, "wall": 0.0, "retained_blocks": 0})
+                p["calls"] += 1
+                p["wall"] += wall
+                p["retained_blocks"] += retained
+
+    def flush(self, stage):
+        with self.lock:
+            phases, self.phases = self.phases, {}
+        if phases:
+            self.file.write(json.dumps({"stage": stage, "phases": phases}) + "\n")
+            self.file.flush()
+
+    def close(self):
+        self.flush("end")
+        self.file.close()
+
+
+def profile(name):
+    # times the `with` block as phase `name` when profiling is on
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.phase(name)
+
+class LineType(IntEnum):
     HEADER = 1
     CO_LINE = 2
     PATCH_HEADER = 3
     PATCH_MINUS = 4
     PATCH_PLUS = 5
 
+# (color pair, attributes) per line type
+LINE_PALLETE = {
+    LineType.HEADER: (24, curses.A_BOLD),
+    LineType.CO_LINE: (24, curses.A_NORMAL),
+    LineType.PATCH_HEADER: (30, curses.A_BOLD),
+    LineType.PATCH_MINUS: (26, curses.A_BOLD),
+    LineType.PATCH_PLUS: (27, curses.A_BOLD),
+}
+
+# first character of the patch lines by line type
+LINE_PREFIX = ("", "", " ", "", "-", "+")
+
+# line type of the staged patch preview by the first character
+PREVIEW_LINE_TYPE = {
+    '@': LineType.PATCH_HEADER,
+    '-': LineType.PATCH_MINUS,
+    '+': LineType.PATCH_PLUS,
+}
+PREVIEW_MIN_COLS = 120
+PARTIAL_SELECT_KEYS = " [n]/[N] next/prev hunk  [h] hunk  [a] file  [i] invert  [p] preview  [q] done "
+
 @dataclass
-class Meta:
-    line_type: LineType
-    patch_header: int
+class HunkHeader:
     line1: int
-    line2: int
     len1: int
+    line2: int
     len2: int
     line: str
-    src: str
 
-def render_box(box, lines, pallete_map, lines_start_offset, cursor_position, lines_selected):
-    # render diff lines inside the box starting with `lines_start_offset`
-    lines_index = 0
-    text_y = 1
+class LineDesc:
+    # description of every line of a patch kept in columns (arrays) rather than an object per line.
+    # 100k lines take ~1.3MB of columns and parse in ~0.1s
+    def __init__(self, lines):
+        self.src = lines
+        self.line_type = array('b')
+        self.patch_header = array('i')   # row of the hunk header the line belongs to, -1 for file header
+        self.old_line = array('i')       # line number in the old file, 0 if the line is not there
+        self.new_line = array('i')       # line number in the new file, 0 if the line is not there
+        self.hunks = {}                  # row of the hunk header -> HunkHeader
+
+    def __len__(self):
+        return len(self.line_type)
+
+class HunkTable:
+    # hunks of a patch: header and end rows and the range of their change rows in the navigation map,
+    # plus a mask of change rows, so whole hunks and files are (de)selected with slice operations
+    def __init__(self, line_desc, nav_map):
+        self.headers = array('i', sorted(line_desc.hunks))
+        self.ends = array('i', self.headers[1:])
+        self.ends.append(len(line_desc))
+        self.nav_first = array('i', (bisect.bisect_left(nav_map, row) for row in self.headers))
+        self.nav_end = array('i', (bisect.bisect_left(nav_map, row) for row in self.ends))
+        self.changes = bytearray(len(line_desc))
+        for row in nav_map:
+            self.changes[row] = 1
+
+    def __len__(self):
+        return len(self.headers)
+
+    def hunk_at(self, nav_index):
+        # hunk of the change row `nav_map[nav_index]`
+        return bisect.bisect_right(self.nav_first, nav_index) - 1
+
+    def toggle_hunk(self, h, lines_selected):
+        # select all changes of the hunk, or none of them if all are selected already
+        start, end = self.headers[h], self.ends[h]
+        mask = self.changes[start:end]
+        lines_selected[start:end] = bytes(len(mask)) if lines_selected[start:end] == mask else mask
+
+    def toggle_all(self, lines_selected):
+        lines_selected[:] = bytes(len(self.changes)) if lines_selected == self.changes else self.changes
+
+    def invert(self, lines_selected):
+        n = len(self.changes)
+        inverted = int.from_bytes(lines_selected, 'big') ^ int.from_bytes(self.changes, 'big')
+        lines_selected[:] = inverted.to_bytes(n, 'big')
+
+def render_box(box, lines, line_desc, lines_start_offset, cursor_position, lines_selected, rows=None):
+    # render diff lines inside the box starting with `lines_start_offset`. Only visible lines are
+    # touched, `rows` narrows the redraw down to the given line indices
     height, width = box.getmaxyx()
     height -= 2 # minus top and bottom border
+    width -= 5
+    end = min(lines_start_offset + height, len(lines))
 
-    for line in lines:
-        # now skip `lines_start_offset` lines
-        if lines_index < lines_start_offset:
-            lines_index += 1
-            continue
+    if rows is None:
+        rows = range(lines_start_offset, end)
+        # blank the rows below the end of the patch
+        for y in range(end - lines_start_offset, height):
+            box.addstr(y + 1, 1, " " * (width + 2))
 
-        while len(line) < width - 5:
-            line += " "
+    for lines_index in rows:
+        if lines_index < lines_start_offset or lines_index >= end:
+            continue
 
-        line = line[:width-5]
+        line = lines[lines_index][:width].translate(DISPLAY_CHARS).ljust(width)
 
         if lines_selected[lines_index]:
             line = "* " + line
         else:
             line = "  " + line
 
-        ci, bi = pallete_map[lines_index]
+        ci, bi = LINE_PALLETE[line_desc.line_type[lines_index]]
         pallete = curses.color_pair(ci + (2 if cursor_position == lines_index else 0)) | bi;
 
-        box.addstr(text_y, 1, line, pallete)
-        lines_index += 1
-        text_y += 1
+        box.addstr(lines_index - lines_start_offset + 1, 1, line, pallete)
+
+def quote_path(prefix, raw_path):
+    # path as libgit2 prints it in patch headers, C-quoted when it has special or non-ASCII bytes
+    path = prefix.encode('utf-8') + raw_path
+    if not any(b == 0x22 or b == 0x5c or b < 0x20 or b > 0x7e for b in path):
+        return path.decode('utf-8', 'surrogateescape')
+    out = '"'
+    for b in path:
+        if 7 <= b <= 13:
+            out += "\\" + "abtnvfr"[b - 7]
+        elif b == 0x22 or b == 0x5c:
+            out += "\\" + chr(b)
+        elif b < 0x20 or b > 0x7e:
+            out += "\\{:03o}".format(b)
+        else:
+            out += chr(b)
+    return out + '"'
+
+
+def abbrev_length(repo):
+    try:
+        return int(repo.config["core.abbrev"])
+    except (KeyError, ValueError):
+        return 7
+
+
+def file_header_lines(repo, delta):
+    # "diff --git" header of a text patch the way libgit2 writes it, without generating the patch text
+    old_path = quote_path("a/", delta.old_file.raw_path)
+    new_path = quote_path("b/", delta.new_file.raw_path)
+    old_mode = delta.old_file.mode
+    new_mode = delta.new_file.mode
+    unchanged = delta.old_file.id == delta.new_file.id
+    lines = ["diff --git {} {}".format(old_path, new_path)]
+    if unchanged and old_mode != new_mode:
+        lines += ["old mode {:o}".format(old_mode), "new mode {:o}".format(new_mode)]
+    if delta.status == DeltaStatus.RENAMED or (delta.status == DeltaStatus.COPIED and unchanged):
+        kind = "rename" if delta.status == DeltaStatus.RENAMED else "copy"
+        lines += ["similarity index {}%".format(delta.similarity),
+                  "{} from {}".format(kind, quote_path("", delta.old_file.raw_path)),
+                  "{} to {}".format(kind, quote_path("", delta.new_file.raw_path))]
+    if unchanged:
+        return lines
+
+    n = abbrev_length(repo)
+    index = "index {}..{}".format(str(delta.old_file.id)[:n], str(delta.new_file.id)[:n])
+    if old_mode == new_mode:
+        lines.append("{} {:o}".format(index, old_mode))
+    else:
+        if old_mode == 0:
+            lines.append("new file mode {:o}".format(new_mode))
+        elif new_mode == 0:
+            lines.append("deleted file mode {:o}".format(old_mode))
+        else:
+            lines += ["old mode {:o}".format(old_mode), "new mode {:o}".format(new_mode)]
+        lines.append(index)
+    lines.append("--- {}".format("/dev/null" if delta.old_file.id == NULL_OID else old_path))
+    lines.append("+++ {}".format("/dev/null" if delta.new_file.id == NULL_OID else new_path))
+    return lines
+
+
+class PatchLines:
+    # rows of a patch streamed from pygit2 hunks: the file header, then the header and the lines of
+    # every hunk, one row per diff line. Only the line descriptions and blob offsets are kept for
+    # the whole file, the text is decoded from the blobs a window of rows at a time. Bytes which are
+    # not UTF-8 survive as surrogate escapes, so the staged patch gets them back unchanged
+    def __init__(self, repo, patch, logger=None):
+        delta = patch.delta
+        self.repo = repo
+        self.ids = (delta.old_file.id, delta.new_file.id)
+        self.blobs = None           # old and new blob, read on the first decoded window
+        self.fixed = {}             # text of the file header, hunk header and "no newline" rows
+        self.side = bytearray()     # blob the text of the row is in: 0 old, 1 new, 2 fixed text
+        self.offset = array('q')
+        self.length = array('i')    # without the newline, only the last line of a blob has none
+        self.windows = {}           # first row -> decoded rows, least recently used first
+        self.nav_map = array('i')   # rows with changes (+/-) the cursor can be placed at
+        self.line_desc = LineDesc(self)
+        self.build(file_header_lines(repo, delta), patch.hunks)
+
+        if TRACE_LINES and logger is not None and logger.isEnabledFor(logging.DEBUG):
+            for row in range(len(self)):
+                logger.debug("{}: {} -> {}: {}".format(row, LineType(self.line_desc.line_type[row]).name,
+                                                       self.line_desc.patch_header[row], self[row]))
+
+    def build(self, header, hunks):
+        ld = self.line_desc
+        line_type = ld.line_type
+        patch_header = ld.patch_header
+        old_line = ld.old_line
+        new_line = ld.new_line
+        side = self.side
+        offset = self.offset
+        length = self.length
+        nav_map = self.nav_map
+
+        def fixed(text, kind, header_row):
+            self.fixed[len(side)] = text
+            line_type.append(kind)
+            patch_header.append(header_row)
+            old_line.append(0)
+            new_line.append(0)
+            side.append(2)
+            offset.append(0)
+            length.append(0)
+
+        for text in header:
+            fixed(text, LineType.HEADER, -1)
+
+        for hunk in hunks:
+            header_row = len(side)
+            text = hunk.header.rstrip("\n")
+            m = HUNK_HEADER_RE.match(text)
+            ld.hunks[header_row] = HunkHeader(hunk.old_start, hunk.old_lines, hunk.new_start, hunk.new_lines, m.group(5) if m else "")
+            fixed(text, LineType.PATCH_HEADER, header_row)
+
+            anchor = -1
+            for line in hunk.lines:
+                o = line.origin
+                if o == '-' or o == '+':
+                    row = len(side)
+                    nav_map.append(row)
+                    if o == '-':
+                        line_type.append(LineType.PATCH_MINUS)
+                        old_line.append(line.old_lineno)
+                        new_line.append(0)
+                        side.append(0)
+                        if anchor < 0 or side[anchor] == 1:
+                            anchor = row
+                    else:
+                        line_type.append(LineType.PATCH_PLUS)
+                        old_line.append(0)
+                        new_line.append(line.new_lineno)
+                        side.append(1)
+                        if anchor < 0:
+                            anchor = row
+                    offset.append(line.content_offset)
+                elif o == ' ':
+                    # libgit2 gives no offset of context lines, it is found from the changes around
+                    line_type.append(LineType.CO_LINE)
+                    old_line.append(line.old_lineno)
+                    new_line.append(line.new_lineno)
+                    side.append(2)
+                    offset.append(-1)
+                else:
+                    fixed("\\ No newline at end of file", LineType.CO_LINE, header_row)
+                    continue
+                patch_header.append(header_row)
+                raw = line.raw_content
+                length.append(len(raw) - (raw[-1:] == b"\n"))
+            self.place_context(header_row + 1, len(side), anchor)
+
+    def place_context(self, first, end, anchor):
+        # context and `-` lines of a hunk are consecutive lines of the old blob, context and `+` lines
+        # of the new one. A `-` line, or a `+` one in hunks without removals, gives the offsets around it
+        if anchor < 0:
+            return
+        side = self.side
+        offset = self.offset
+        length = self.length
+        blob = side[anchor]
+        pos = offset[anchor]
+        for row in range(anchor - 1, first - 1, -1):
+            if offset[row] < 0:
+                pos -= length[row] + 1
+                offset[row] = pos
+                side[row] = blob
+            elif side[row] == blob:
+                pos -= length[row] + 1
+        pos = offset[anchor]
+        for row in range(anchor, end):
+            if offset[row] < 0:
+                offset[row] = pos
+                side[row] = blob
+                pos += length[row] + 1
+            elif side[row] == blob:
+                pos += length[row] + 1
+
+    def __len__(self):
+        return len(self.side)
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            # slices are read through, e.g. a whole hunk, and do not evict the windows on the screen
+            start, stop, step = row.indices(len(self))
+            if step != 1:
+                return [self[r] for r in range(start, stop, step)]
+            return self.decode(start, stop) if start < stop else []
+        if row < 0:
+            row += len(self)
+        if row < 0 or row >= len(self):
+            raise IndexError(row)
+        start = row - row % PATCH_WINDOW
+        window = self.windows.pop(start, None)
+        if window is None:
+            window = self.decode(start, min(start + PATCH_WINDOW, len(self)))
+            if len(self.windows) >= PATCH_WINDOWS:
+                del self.windows[next(iter(self.windows))]
+        self.windows[start] = window
+        return window[row - start]
+
+    def decode(self, start, end):
+        if self.blobs is None:
+            # bytes rather than memoryviews, slices of those would keep the garbage collector busy
+            self.blobs = tuple(self.repo[i].data if i != NULL_OID else b"" for i in self.ids)
+        blobs = self.blobs
+        side = self.side
+        offset = self.offset
+        length = self.length
+        line_type = self.line_desc.line_type
+        fixed = self.fixed
+        out = []
+        for row in range(start, end):
+            blob = side[row]
+            if blob == 2:
+                out.append(fixed[row])
+            else:
+                off = offset[row]
+                out.append(LINE_PREFIX[line_type[row]] + str(blobs[blob][off:off + length[row]], 'utf-8', 'surrogateescape'))
+        return out
+
+
+class PatchBuilder:
+    # output patch of a partial selection kept per hunk. A selection change invalidates only its own
+    # hunk, the hunks are then put together in O(hunks), or just a window of them for the preview.
+    # Hunks keep the rows they are made of rather than the text, which is read only for the output
+    KEEP = 0        # the row as it is
+    CONTEXT = 1     # unselected `-` row as context
+    READD = 2       # `-` row added back, with a newline
+
+    def __init__(self, lines, lines_selected, line_desc, logger):
+        self.lines = lines
+        self.selected = lines_selected
+        self.line_desc = line_desc
+        self.logger = logger
+        self.headers = sorted(line_desc.hunks)
+        self.ends = self.headers[1:] + [len(lines)]
+        self.index = {row: h for h, row in enumerate(self.headers)}
+        self.cache = [None] * len(self.headers)
+        self.version = 0
+
+    def hunk_of(self, row):
+        # number of the hunk the row belongs to, -1 for the file header
+        return self.index.get(self.line_desc.patch_header[row], -1)
+
+    def invalidate(self, row):
+        # selection of the row has changed
+        h = self.hunk_of(row)
+        if h >= 0:
+            self.cache[h] = None
+        self.version += 1
+
+    def invalidate_all(self):
+        self.cache = [None] * len(self.headers)
+        self.version += 1
+
+    def is_marker(self, row):
+        # "no newline" marker, the only context row which is in neither file
+        return self.line_desc.line_type[row] == LineType.CO_LINE and self.line_desc.old_line[row] == 0
+
+    def hunk(self, h):
+        # (body, old start, old length, new start, new length, shift of the later hunks, is active),
+        # body is an array of `row << 2 | op`. Unselected `-` lines become context, unselected `+` lines are dropped
+        if self.cache[h] is not None:
+            return self.cache[h]
+        selected = self.selected
+        line_type = self.line_desc.line_type
+        header = self.line_desc.hunks[self.headers[h]]
+        end = self.ends[h]
+        trace = TRACE_LINES and self.logger.isEnabledFor(logging.DEBUG)
+
+        body = array('q')
+        old_len = 0
+        new_len = 0
+        shift = 0
+        lead = -1
+        kept = True
+        readd = -1
+        for row in range(self.headers[h] + 1, end):
+            t = line_type[row]
+            if t == LineType.PATCH_PLUS:
+                kept = selected[row]
+                if kept:
+                    body.append(row << 2)
+                    new_len += 1
+                else:
+                    shift -= 1
+            elif t == LineType.PATCH_MINUS:
+                kept = True
+                old_len += 1
+                if selected[row]:
+                    body.append(row << 2)
+                elif row + 1 < end and self.is_marker(row + 1) and self.adds_after(h, row):
+                    # last line of the old file has no newline, it stays but gets the one the selected lines after it need
+                    body.append(row << 2)
+                    readd = row
+                    new_len += 1
+                    shift += 1
+                    if lead < 0:
+                        lead = len(body) - 1
+                else:
+                    body.append(row << 2 | self.CONTEXT)
+                    new_len += 1
+                    shift += 1
+            elif self.is_marker(row):
+                # "no newline" marker goes along with the line it belongs to
+                if kept:
+                    body.append(row << 2)
+                if readd >= 0:
+                    body.append(readd << 2 | self.READD)
+                    readd = -1
+                continue
+            else:
+                kept = True
+                body.append(row << 2)
+                old_len += 1
+                new_len += 1
+            if lead < 0 and t != LineType.CO_LINE and selected[row]:
+                lead = len(body) - 1
+            if trace:
+                self.logger.debug("hunk {} row {}: {}".format(h, row, self.text(body[-1]) if kept else "(dropped)"))
+
+        # leave 3 lines of leading context
+        cut = max(lead - 3, 0)
+        for i in range(cut):
+            if self.is_marker(body[i] >> 2):
+                cut = max(i - 1, 0)
+                break
+        del body[:cut]
+        self.cache[h] = (body, header.line1 + cut, old_len - cut, header.line2 + cut, new_len - cut, shift, lead >= 0)
+        return self.cache[h]
+
+    def adds_after(self, h, row):
+        # any `+` row of the hunk after `row` is selected
+        line_type = self.line_desc.line_type
+        return any(self.selected[r] and line_type[r] == LineType.PATCH_PLUS for r in range(row + 1, self.ends[h]))
+
+    def text(self, code, src=None):
+        # output line of a body entry, `src` is the text of its row if it is at hand
+        if src is None:
+            src = self.lines[code >> 2]
+        op = code & 3
+        if op == self.KEEP:
+            return src
+        return (" " if op == self.CONTEXT else "+") + src[1:]
+
+    def file_header(self):
+        return self.lines[:self.headers[0]] if self.headers else list(self.lines)
+
+    def layout(self):
+        # (output row of the header, hunk, new start shift from the earlier hunks) per active hunk, and the patch length
+        out = []
+        row = len(self.file_header())
+        shift = 0
+        for h in range(len(self.headers)):
+            body, old_start, old_len, new_start, new_len, hunk_shift, active = self.hunk(h)
+            if active:
+                out.append((row, h, shift))
+                row += 1 + len(body)
+            shift += hunk_shift
+        return (out, row)
+
+    def header(self, h, shift):
+        body, old_start, old_len, new_start, new_len, hunk_shift, active = self.hunk(h)
+        return "@@ -{},{} +{},{} @@ {}".format(old_start, old_len, new_start + shift, new_len, self.line_desc.hunks[self.headers[h]].line)
+
+    def window(self, layout, first, count):
+        # `count` lines of the output patch starting with row `first`, only those are read
+        out = []
+        file_header = self.file_header()
+        if first < len(file_header):
+            out.extend(file_header[first:first + count])
+        i = max(bisect.bisect_right(layout, (first, len(self.headers))) - 1, 0)
+        for row, h, shift in layout[i:]:
+            if len(out) >= count:
+                break
+            skip = max(first - row, 0)
+            if skip == 0:
+                out.append(self.header(h, shift))
+                skip = 1
+            body = self.hunk(h)[0]
+            out.extend(self.text(code) for code in body[skip - 1:skip - 1 + count - len(out)])
+        return out
+
+    def patch(self):
+        # whole output patch as a list of lines, None if nothing is selected
+        layout, total = self.layout()
+        self.logger.debug("hunks exported: {}".format(len(layout)))
+        if not layout:
+            return None
+        out = self.file_header()
+        for row, h, shift in layout:
+            out.append(self.header(h, shift))
+            first = self.headers[h] + 1
+            texts = self.lines[first:self.ends[h]]
+            out.extend(self.text(code, texts[(code >> 2) - first]) for code in self.hunk(h)[0])
+        return out
 
-        if text_y > height:
-            break
 
-def gen_navigation_map(box, lines, logger):
-    # what is a navigation map? It is an array of tuples (lines_start_offset, position)
-    out = []
-    out_pallete = []
-    out_linedesc = []
+def generate_patch(lines, lines_selected, line_desc, logger):
+    return PatchBuilder(lines, lines_selected, line_desc, logger).patch()
 
-    header_mode = True
-    lines_index = 0
+def render_preview(box, builder, cursor_position):
+    # the exact patch which goes to the stage, scrolled to the hunk under the cursor
     height, width = box.getmaxyx()
-    height -= 3
-    last_patch_header_line = -1
-
-    for line in lines:
-        pallete = (24, curses.A_NORMAL)
-        out_linedesc.append(Meta(LineType.CO_LINE, 0, 0, 0, 0, 0, "", ""))
-
-        out_linedesc[lines_index].src = line
-        current_patch_header = re.search(r"@@\s*\-([0-9]+),([0-9]+)\s+\+([0-9]+),([0-9]+)\s*@@\s*(.*)", line)
-        if current_patch_header:
-            out_linedesc[lines_index].line_type = LineType.PATCH_HEADER
-            last_patch_header_line = lines_index
-            header_mode = False
-            pallete = (30, curses.A_BOLD)
-            out_linedesc[lines_index].line1 = int(current_patch_header.groups()[0]);
-            out_linedesc[lines_index].len1 = int(current_patch_header.groups()[1]);
-            out_linedesc[lines_index].line2 = int(current_patch_header.groups()[2]);
-            out_linedesc[lines_index].len2 = int(current_patch_header.groups()[3]);
-            out_linedesc[lines_index].line = current_patch_header.groups()[4];
-            logger.debug("patch header: {}".format(str(out_linedesc[lines_index])))
-        if not current_patch_header:
-            current_patch_header = re.search(r"@@\s*\-([0-9]+),([0-9]+)\s+\+([0-9]+)\s*@@\s*(.*)", line)
-            if current_patch_header:
-                out_linedesc[lines_index].line_type = LineType.PATCH_HEADER
-                last_patch_header_line = lines_index
-                header_mode = False
-                pallete = (30, curses.A_BOLD)
-                out_linedesc[lines_index].line1 = int(current_patch_header.groups()[0]);
-                out_linedesc[lines_index].len1 = int(current_patch_header.groups()[1]);
-                out_linedesc[lines_index].line2 = int(current_patch_header.groups()[2]);
-                out_linedesc[lines_index].len2 = int(current_patch_header.groups()[2]);
-                out_linedesc[lines_index].line = current_patch_header.groups()[3];
-                logger.debug("patch header (type 2): {}".format(str(out_linedesc[lines_index])))
-
-        if header_mode:
-            pallete = (24, curses.A_BOLD)
-            out_linedesc[lines_index].line_type = LineType.HEADER
-
-        if len(line)>=1 and (line[0] == '-' or line[0] == '+') and not header_mode:
-            scroll_oft = lines_index - height if lines_index > height else 0
-            out.append((scroll_oft, lines_index))
-            pallete = (26 +  (1 if line[0] == '+' else 0), curses.A_BOLD)
-            out_linedesc[lines_index].line_type = LineType.PATCH_MINUS if line[0] == '-' else LineType.PATCH_PLUS
-            out_linedesc[lines_index].patch_header = last_patch_header_line
-
-        if out_linedesc[lines_index].line_type == LineType.CO_LINE:
-            out_linedesc[lines_index].patch_header = last_patch_header_line
-
-        logger.debug("{}: {} -> {}: {}".format(str(lines_index), out_linedesc[lines_index].line_type.name, out_linedesc[lines_index].patch_header, out_linedesc[lines_index].src))
-
-        out_pallete.append(pallete)
-
-        lines_index += 1
-    return (out, out_pallete, out_linedesc)
-
+    height -= 2 # minus top and bottom border
+    width -= 2
+    layout, total = builder.layout()
+    header_rows = len(builder.file_header())
+    hunk = builder.hunk_of(cursor_position)
+
+    # keep the line under the cursor around the middle of the pane
+    target = 0
+    for row, h, shift in layout:
+        if h > hunk:
+            break
+        target = row
+        if h == hunk:
+            target += min(cursor_position - builder.headers[h], len(builder.hunk(h)[0]))
+    first = max(target - height // 2, 0)
 
-def generate_patch(lines, lines_selected, line_desc, logger):
-    out_patch = []
-    patch_line_index = 0
-    line_index = 0
-    last_patch_header = -1
-    len_minus = 0
-    len_plus = 0
-    skipped = 0
-    skipped_prev = 0
-    active_patch_header = None
-    prev_patch_line_index = 0
-    hunks = 0
-
-    logger.debug("===========================================================================================")
-
-    for d in line_desc:
-        # write all headers
-        if d.line_type == LineType.HEADER:
-            out_patch.append(d.src)
-            logger.debug("{:2d}.HEADER: {}".format(patch_line_index, d.src))
-            patch_line_index += 1
-
-        elif d.line_type == LineType.PATCH_HEADER:
-
-            # remove previous hunk if no activity there
-            if last_patch_header > 0 and not active_patch_header:
-                logger.debug("remove hunk from {}".format(last_patch_header))
-                del out_patch[last_patch_header:]
-                patch_line_index = last_patch_header
-                skipped_prev = skipped
-            # fix the patch header for previous hunk
-            elif last_patch_header > 0 and active_patch_header:
-                logger.debug("active patch header: {}".format(str(active_patch_header)))
-                uc = 0
-                for p in range(last_patch_header+1, patch_line_index):
-                    if out_patch[p][0] == '+' or out_patch[p][0] == '-':
-                        break
-                    uc += 1
-                if uc > 3:
-                    del out_patch[last_patch_header:last_patch_header + uc - 3]
-                uc = uc - 3
-                if uc < 0:
-                    uc = 0
-                logger.debug("uc = {}, remove from: {} to {}, skipped: {}, skipped_prev: {}".format(uc,last_patch_header, last_patch_header+uc+1, skipped, skipped_prev))
-                out_patch[last_patch_header] = "@@ -{},{} +{},{} @@ {}".format(active_patch_header.line1 + uc, len_plus - uc, active_patch_header.line2 + uc + skipped_prev, len_minus - uc, active_patch_header.line)
-                patch_line_index -= uc
-                skipped_prev = skipped
-                hunks += 1
-
-            last_patch_header = patch_line_index
-            out_patch.append(d.src)
-            logger.debug("{:2d}.PHDR  : {}".format(patch_line_index, d.src))
-            patch_line_index += 1
-            len_minus = 0
-            len_plus = 0
-            active_patch_header = None
-
-        elif d.line_type == LineType.CO_LINE:
-            out_patch.append(d.src)
-            len_minus += 1
-            len_plus += 1
-            logger.debug("{:2d}.COLINE: {}".format(patch_line_index, d.src))
-            patch_line_index += 1
-        elif d.line_type == LineType.PATCH_PLUS and lines_selected[line_index]:
-            out_patch.append(d.src)
-            logger.debug("{:2d}.P_PLUS: {}".format(patch_line_index, d.src))
-            patch_line_index += 1
-            len_minus += 1
-            active_patch_header = line_desc[d.patch_header]
-        elif d.line_type == LineType.PATCH_MINUS and lines_selected[line_index]:
-            out_patch.append(d.src)
-            logger.debug("{:2d}.P_MIN : {}".format(patch_line_index, d.src))
-            patch_line_index += 1
-            len_plus += 1
-            active_patch_header = line_desc[d.patch_header]
-        elif d.line_type == LineType.PATCH_MINUS:
-            co_line = " " + d.src[1:]
-            len_plus += 1
-            len_minus += 1
-            patch_line_index += 1
-            skipped += 1
-            out_patch.append(co_line)
-            logger.debug("MINUS: skipped = {}".format(skipped))
-        elif d.line_type == LineType.PATCH_PLUS:
-            skipped -= 1
-            logger.debug("PLUS : skipped = {}".format(skipped))
-
-        line_index += 1
-
-    # remove previous hunk if no activity there
-    if last_patch_header > 0 and not active_patch_header:
-        logger.debug("remove hunk from {}".format(last_patch_header))
-        del out_patch[last_patch_header:]
-    elif last_patch_header > 0 and active_patch_header:
-        logger.debug("LAST: active patch header: {}".format(str(active_patch_header)))
-        uc = 0
-        for p in range(last_patch_header+1, patch_line_index):
-            if out_patch[p][0] == '+' or out_patch[p][0] == '-':
-                break
-            uc += 1
-        if uc > 3:
-            del out_patch[last_patch_header:last_patch_header + uc - 3]
-        uc = uc - 3
-        if uc < 0:
-            uc = 0
-        logger.debug("LAST: uc = {}".format(uc))
-        out_patch[last_patch_header] = "@@ -{},{} +{},{} @@ {}".format(active_patch_header.line1 + uc, len_plus - (uc), active_patch_header.line2 + uc + skipped_prev, len_minus - (uc), active_patch_header.line)
-        hunks += 1
-
-    # report outcome
-    logger.debug("hunks exported: {}".format(hunks))
-    for p in out_patch:
-        logger.debug(">>> {}".format(p))
-    if not hunks:
-        return None
-    else:
-        return out_patch
+    box.erase()
+    box.box()
+    box.addstr(0, 2, " staged patch, [p] hides "[:width])
+    if not layout:
+        box.addstr(1, 1, "nothing selected"[:width], curses.color_pair(24))
+        return
+
+    for y, line in enumerate(builder.window(layout, first, height)):
+        if first + y < header_rows:
+            line_type = LineType.HEADER
+        else:
+            line_type = PREVIEW_LINE_TYPE.get(line[:1], LineType.CO_LINE)
+        ci, bi = LINE_PALLETE[line_type]
+        box.addstr(y + 1, 1, line[:width].translate(DISPLAY_CHARS).ljust(width), curses.color_pair(ci) | bi)
 
-def partially_select(stdscr, diffconfig, logger):
+def partially_select(stdscr, diffconfig, logger, jump_rows=None):
     max_row = curses.LINES - 2
-    box = curses.newwin( max_row + 2, curses.COLS, 0, 0 )
-    box.box()
+    show_preview = curses.COLS >= PREVIEW_MIN_COLS
 
-    logger.debug("open partially select dialog")
+    def layout_boxes():
+        # diff on the left, staged patch on the right
+        width = curses.COLS // 2 if show_preview else curses.COLS
+        box = curses.newwin( max_row + 2, width, 0, 0 )
+        box.box()
+        box.addstr(max_row + 1, 2, PARTIAL_SELECT_KEYS[:width - 4])
+        preview = curses.newwin( max_row + 2, curses.COLS - width, 0, width ) if show_preview else None
+        return (box, preview)
+
+    box, preview = layout_boxes()
 
-    # parse lines
-    text_patch = diffconfig.patch.data.decode('utf-8')
-    lines = text_patch.splitlines()
-    lines_selected = []
+    logger.debug("open partially select dialog")
 
-    for line in lines:
-        lines_selected.append(False)
+    lines = diffconfig.patch_lines()
+    nav_map = lines.nav_map
+    line_desc = lines.line_desc
+    if diffconfig.lines_selected is None:
+        diffconfig.lines_selected = bytearray(len(lines))
+    lines_selected = diffconfig.lines_selected
 
-    # now create a map of navigation
-    nav_map, pallete_map, line_desc = gen_navigation_map(box, lines, logger)
+    builder = PatchBuilder(lines, lines_selected, line_desc, logger)
+    hunks = HunkTable(line_desc, nav_map)
 
     nav_map_index = 0
     scroll_offset = 0
     height, width = box.getmaxyx()
     height -= 4 # minus top and bottom border
 
+    if jump_rows:
+        # start at the first search match
+        nav_map_index = min(bisect.bisect_left(nav_map, jump_rows[0]), len(nav_map) - 1)
+        scroll_offset = max(nav_map[nav_map_index] - height // 2, 0)
+
+    # rows to redraw, None means the whole box
+    dirty = None
+    drawn_offset = None
+    drawn_preview = None
+
     while True:
         # now draw the patches
 
-        n1, n2 = nav_map[nav_map_index]
-        render_box(box, lines, pallete_map, scroll_offset, n2, lines_selected)
+        n2 = nav_map[nav_map_index]
+        if drawn_offset != scroll_offset:
+            dirty = None
+        with profile("render"):
+            render_box(box, lines, line_desc, scroll_offset, n2, lines_selected, dirty)
+            if preview and drawn_preview != (builder.version, n2):
+                render_preview(preview, builder, n2)
+                drawn_preview = (builder.version, n2)
+        drawn_offset = scroll_offset
 
         stdscr.refresh()
         box.refresh()
+        if preview:
+            preview.refresh()
+
+        # the cursor leaves its row whatever the key is
+        dirty = {n2}
 
         key = stdscr.getch()
         if key == curses.KEY_F10 or key == 113:
@@ -300,7 +746,7 @@ def partially_select(stdscr, diffconfig, logger):
         if key == curses.KEY_DOWN:
             if nav_map_index + 1 < len(nav_map):
                 nav_map_index += 1
-                n1, n2 = nav_map[nav_map_index]
+                n2 = nav_map[nav_map_index]
             elif scroll_offset + height + 2 < len(lines):
                 scroll_offset += 1
             if n2 - scroll_offset > height:
@@ -312,19 +758,55 @@ def partially_select(stdscr, diffconfig, logger):
             elif scroll_offset > 0:
                 scroll_offset -= 1
             if n2 - scroll_offset <= 0:
-                n1, n2 = nav_map[nav_map_index]
+                n2 = nav_map[nav_map_index]
                 scroll_offset = n2
 
         if key == 32:
             lines_selected[n2] = not lines_selected[n2]
+            builder.invalidate(n2)
+
+        if key == ord('n') or key == ord('N'):
+            # next / previous hunk
+            h = hunks.hunk_at(nav_map_index) + (1 if key == ord('n') else -1)
+            if 0 <= h < len(hunks) and hunks.nav_first[h] < hunks.nav_end[h]:
+                nav_map_index = hunks.nav_first[h]
+                n2 = nav_map[nav_map_index]
+                if hunks.headers[h] < scroll_offset or n2 - scroll_offset > height:
+                    scroll_offset = hunks.headers[h]
+
+        if key == ord('h'):
+            hunks.toggle_hunk(hunks.hunk_at(nav_map_index), lines_selected)
+            builder.invalidate(n2)
+            drawn_offset = None
+
+        if key == ord('a'):
+            hunks.toggle_all(lines_selected)
+            builder.invalidate_all()
+            drawn_offset = None
+
+        if key == ord('i'):
+            hunks.invert(lines_selected)
+            builder.invalidate_all()
+            drawn_offset = None
+
+        if key == ord('p'):
+            show_preview = not show_preview
+            del box, preview
+            box, preview = layout_boxes()
+            dirty = None
+            drawn_offset = None
+            drawn_preview = None
+            continue
 
         if key == curses.KEY_RIGHT:
             sel_type = None
             while n2 < len(lines):
                 if not sel_type:
-                    sel_type = line_desc[n2].line_type
-                if line_desc[n2].line_type == sel_type:
+                    sel_type = line_desc.line_type[n2]
+                if line_desc.line_type[n2] == sel_type:
                     lines_selected[n2] = not lines_selected[n2]
+                    builder.invalidate(n2)
+                    dirty.add(n2)
                 else:
                     break
                 n2 += 1
@@ -333,15 +815,20 @@ def partially_select(stdscr, diffconfig, logger):
             sel_type = None
             while n2 > 0:
                 if not sel_type:
-                    sel_type = line_desc[n2].line_type
-                if line_desc[n2].line_type == sel_type:
+                    sel_type = line_desc.line_type[n2]
+                if line_desc.line_type[n2] == sel_type:
                     lines_selected[n2] = not lines_selected[n2]
+                    builder.invalidate(n2)
+                    dirty.add(n2)
                 else:
                     break
                 n2 -= 1
 
-    del box
-    return generate_patch(lines, lines_selected, line_desc, logger)
+        dirty.add(nav_map[nav_map_index])
+
+    del box, preview
+    with profile("generate patch"):
+        return builder.patch()
 
 def main_box():
     max_row = curses.LINES - 2
@@ -349,19 +836,1409 @@ def main_box():
     box.box()
 
     box.addstr(1,1, "Please select changes you want to separate. Use [space] to mark patches to include to the step. Use [enter] to split the modification.")
-    box.addstr(2,1, "When ready to commit stage press [F2]")
+    box.addstr(2,1, "When ready to commit stage press [F2]. [PgUp]/[PgDn] scroll the list, [g] jumps to a path, [/] searches changes, [P] proposes a stage")
     return box
 
 
+def list_page_size(box):
+    # rows of the file list, the list starts at row 4 and ends above the bottom border
+    height, width = box.getmaxyx()
+    return max(height - 5, 1)
+
+
+def render_file_list(box, deltas, cfg, top, pos, matches=None, note=None):
+    # draw visible part of the file list, returns the top row keeping `pos` in the view.
+    # `matches` maps file index to rows matching the search, `note` goes to the bottom border otherwise
+    height, width = box.getmaxyx()
+    rows = list_page_size(box)
+    start_oft = 4
+
+    if pos < top:
+        top = pos
+    elif pos >= top + rows:
+        top = pos - rows + 1
+
+    for row in range(rows):
+        i = top + row
+        if i >= len(deltas):
+            box.addstr(start_oft + row, 1, " " * (width - 2))
+            continue
+        marking = cfg[i].marking() if cfg[i] is not None else ' '
+        if deltas[i].status == DeltaStatus.RENAMED or deltas[i].status == DeltaStatus.COPIED:
+            line = "[{}] {} -> {}".format(marking, deltas[i].old_file.path, deltas[i].new_file.path)
+        else:
+            line = "[{}] {}".format(marking, deltas[i].new_file.path)
+        if matches and i in matches:
+            line += "  ({} matches)".format(len(matches[i]))
+        line = line[:width-2].ljust(width-2)
+        box.addstr(start_oft + row, 1, line, curses.color_pair(deltas[i].status + (12 if pos == i else 0)))
+
+    box.hline(height - 1, 1, curses.ACS_HLINE, width - 2)
+    box.addstr(height - 1, 2, " {}/{} ".format(pos + 1 if deltas else 0, len(deltas)))
+    if matches:
+        box.addstr(height - 1, 14, " {} files match, [n]/[N] next/prev, [*] stage the matching lines ".format(len(matches))[:width - 16])
+    elif note:
+        box.addstr(height - 1, 14, " {} ".format(note)[:width - 16])
+    return top
+
+
+def find_path(deltas, pattern, pos):
+    # index of the next file (after `pos`, wrapping around) whose path contains `pattern`
+    n = len(deltas)
+    for k in range(1, n + 1):
+        i = (pos + k) % n
+        if pattern in deltas[i].new_file.path or pattern in deltas[i].old_file.path:
+            return i
+    return pos
+
+
+def prompt(box, text):
+    # read a line of text at the bottom of the box
+    height, width = box.getmaxyx()
+    box.addstr(height - 2, 1, text.ljust(width - 2))
+    curses.echo()
+    curses.curs_set(1)
+    try:
+        value = box.getstr(height - 2, 1 + len(text), width - 3 - len(text))
+    finally:
+        curses.noecho()
+        curses.curs_set(0)
+    box.addstr(height - 2, 1, " " * (width - 2))
+    return value.decode('utf-8', 'replace').strip()
+
+
+def read_query(stdscr, box, text, on_change):
+    # line editor at the bottom of the box, `on_change(value)` runs after every key and returns a status
+    # shown on the right. Returns the value on Enter and None on Esc
+    height, width = box.getmaxyx()
+    value = ""
+    curses.curs_set(1)
+    # keep refreshing the status while the search index is being built
+    stdscr.timeout(200)
+    try:
+        while True:
+            status = on_change(value)
+            line = (text + value)[:width - 2]
+            box.addstr(height - 2, 1, (line + status.rjust(width - 2 - len(line)))[:width - 2])
+            box.move(height - 2, 1 + len(line))
+            box.refresh()
+            try:
+                key = stdscr.get_wch()
+            except curses.error:
+                continue
+            if key in ("\n", "\r", curses.KEY_ENTER):
+                return value
+            if key == "\x1b":
+                return None
+            if key in ("\x7f", "\b", curses.KEY_BACKSPACE):
+                value = value[:-1]
+            elif isinstance(key, str) and key.isprintable():
+                value += key
+    finally:
+        stdscr.timeout(-1)
+        curses.curs_set(0)
+        box.addstr(height - 2, 1, " " * (width - 2))
+
+
+class SearchIndex:
+    # lines of every patch of a diff, built once in a background thread. A file is kept as a single
+    # string with an array of line offsets, so a query is a str.find loop per file
+    def __init__(self, repo_path, old, new, count, previous=None):
+        self.files = [None] * count  # (text, line offsets, row of the first hunk header)
+        self.keys = [None] * count
+        self.indexed = 0
+        self.cancelled = False
+        # files the last stage did not touch are not read again
+        carried = previous.entries() if previous else {}
+        self.thread = threading.Thread(target=self.run, args=(repo_path, old, new, carried), daemon=True)
+        self.thread.start()
+
+    def run(self, repo_path, old, new, carried):
+        # the diff of the file list is not shared with this thread, it has its own one
+        with profile("search index"):
+            repo = pygit2.Repository(repo_path)
+            diff = stage_diff(repo, old, new)
+            for i, delta in enumerate(diff.deltas):
+                if self.cancelled:
+                    return
+                key = delta_key(delta)
+                if key in carried:
+                    self.files[i] = carried[key]
+                    self.keys[i] = key
+                    self.indexed = i + 1
+                    continue
+                patch = diff[i]
+                if not patch.delta.is_binary:
+                    # same rows as the partial selection view has
+                    lines = PatchLines(repo, patch)
+                    rows = list(lines)
+                    offsets = array('q', [0])
+                    for line in rows:
+                        offsets.append(offsets[-1] + len(line) + 1)
+                    first_hunk = min(lines.line_desc.hunks, default=len(rows))
+                    self.files[i] = ("\n".join(rows), offsets, first_hunk)
+                self.keys[i] = key
+                self.indexed = i + 1
+
+    def entries(self):
+        # files indexed so far by delta_key
+        indexed = self.indexed
+        return {self.keys[i]: self.files[i] for i in range(indexed)}
+
+    def is_complete(self):
+        return self.indexed == len(self.files)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def match(self, i, query):
+        # change rows (+/-) of file `i` containing `query`
+        rows = array('i')
+        if self.files[i] is None or not query:
+            return rows
+        text, offsets, first_hunk = self.files[i]
+        start = offsets[first_hunk]
+        while (p := text.find(query, start)) >= 0:
+            row = bisect.bisect_right(offsets, p) - 1
+            if text[offsets[row]] in "+-":
+                rows.append(row)
+            start = offsets[row + 1]
+        return rows
+
+    def query(self, query, within=None):
+        # {file index: matching change rows} over the files indexed so far. `within` are the files
+        # to look at, e.g. the matches of a shorter query when the new one extends it
+        matches = {}
+        for i in range(self.indexed) if within is None else within:
+            rows = self.match(i, query)
+            if rows:
+                matches[i] = rows
+        return matches
+
+
+def is_identifier(word):
+    # names like `mirror_url`, `AWS_REGION`, `HunkIndex` or `sha256`, plain words like `else` or
+    # `Update` are in too many unrelated changes
+    if not IDENTIFIER_RE.fullmatch(word):
+        return False
+    return b"_" in word or not (word.islower() or word.istitle()) or any(c in b"0123456789" for c in word)
+
+
+def index_hunks(repo_path, files):
+    # hunks of `files` given as (file index, old blob, new blob), None for a missing side.
+    # Returns [(file index, [(function context, old start, old end, identifiers, edit)])] where the
+    # edit are the words the hunk adds or removes, the same edit all over the range is one change.
+    # Runs in the worker processes of HunkIndex, blob patches have the hunks of the stage diff
+    repo = pygit2.Repository(repo_path)
+    indexed = []
+    for i, old, new in files:
+        patch = pygit2.Patch.create_from(repo[old] if old else None, repo[new] if new else None)
+        hunks = []
+        if not patch.delta.is_binary:
+            for hunk in patch.hunks:
+                m = HUNK_HEADER_RE.match(hunk.header)
+                added = set()
+                removed = set()
+                for line in hunk.lines:
+                    if line.origin == '+':
+                        added.update(WORD_RE.findall(line.raw_content))
+                    elif line.origin == '-':
+                        removed.update(WORD_RE.findall(line.raw_content))
+                edit = frozenset([b"+" + w for w in added - removed] + [b"-" + w for w in removed - added])
+                tokens = frozenset(w for w in added | removed if is_identifier(w))
+                hunks.append((m.group(5).strip() if m else "", hunk.old_start, hunk.old_start + hunk.old_lines, tokens, edit))
+        indexed.append((i, hunks))
+    return indexed
+
+
+def cochange_counts(repo, commit, paths, cancelled=None):
+    # how often pairs of `paths` changed together in the history of `commit`, and each of them at all
+    counts = {}
+    for n, c in enumerate(repo.walk(commit, SortMode.TIME)):
+        if n >= COCHANGE_COMMITS or (cancelled and cancelled()):
+            break
+        if len(c.parents) != 1:
+            continue
+        d = repo.diff(c.parents[0], c)
+        if len(d) > COCHANGE_MAX_FILES:
+            continue
+        touched = sorted({p for delta in d.deltas for p in (delta.old_file.path, delta.new_file.path)} & paths)
+        for path in touched:
+            counts[path] = counts.get(path, 0) + 1
+        for pair in itertools.combinations(touched, 2):
+            counts[pair] = counts.get(pair, 0) + 1
+    return counts
+
+
+def group_hunks(files, hunks, cochange):
+    # proposed stages as [{file index: 1-based hunk numbers, None for the whole file}]. Hunks are
+    # merged by the closest relation first: the same edit, function context and distance within a
+    # file, rare identifiers changed together, files which changed together before, then the file
+    # and the directory. Only the same edit makes a group bigger than PROPOSAL_MAX_HUNKS.
+    # `files` are (file index, old path, new path, status), `hunks` map a file index to its hunks
+    nodes = []      # (file index, hunk number), 0 for a file without hunks
+    by_file = {}
+    postings = {}
+    edits = {}
+    for i, old_path, new_path, status in files:
+        by_file[i] = []
+        stems = set()
+        if status != DeltaStatus.MODIFIED or not hunks.get(i):
+            # added, removed and moved files relate to the changes which mention them
+            for path in (old_path, new_path):
+                stem = os.path.splitext(os.path.basename(path))[0].encode('utf-8', 'surrogateescape')
+                if IDENTIFIER_RE.fullmatch(stem):
+                    stems.add(stem)
+        for h, (section, old_start, old_end, tokens, edit) in enumerate(hunks.get(i) or [("", 0, 0, frozenset(), None)], 1):
+            n = len(nodes)
+            nodes.append((i, h if hunks.get(i) else 0))
+            by_file[i].append(n)
+            for token in tokens | stems:
+                postings.setdefault(token, []).append(n)
+            if edit:
+                edits.setdefault(edit, []).append(n)
+
+    parent = list(range(len(nodes)))
+    size = [1] * len(nodes)
+
+    def find(n):
+        while parent[n] != n:
+            parent[n] = parent[parent[n]]
+            n = parent[n]
+        return n
+
+    def union(a, b, limit=PROPOSAL_MAX_HUNKS):
+        a, b = find(a), find(b)
+        if a == b or size[a] + size[b] > limit:
+            return
+        if size[a] < size[b]:
+            a, b = b, a
+        parent[b] = a
+        size[a] += size[b]
+
+    def groups():
+        found = {}
+        for n in range(len(nodes)):
+            found.setdefault(find(n), []).append(n)
+        return found
+
+    for same in edits.values():
+        for n in same[1:]:
+            union(same[0], n, len(nodes))
+
+    for i, members in by_file.items():
+        file_hunks = hunks.get(i) or []
+        for k in range(1, len(file_hunks)):
+            section, old_start = file_hunks[k][:2]
+            if (section and section == file_hunks[k - 1][0]) or old_start - file_hunks[k - 1][2] <= PROPOSAL_NEAR_LINES:
+                union(members[k - 1], members[k])
+
+    rare = min(PROPOSAL_RARE_TOKEN, max(len(nodes) // 10, 2))
+    for token, postings_list in sorted(postings.items(), key=lambda p: len(p[1])):
+        if len(postings_list) > rare:
+            break
+        for n in postings_list[1:]:
+            union(postings_list[0], n)
+
+    # files changed together in at least half of the commits of the less often changed one
+    index_of = {}
+    for i, old_path, new_path, status in files:
+        index_of[old_path] = i
+        index_of[new_path] = i
+    related = [(count, pair) for pair, count in cochange.items()
+               if isinstance(pair, tuple) and count >= 2 and 2 * count >= min(cochange[pair[0]], cochange[pair[1]])]
+    for count, (a, b) in sorted(related, reverse=True):
+        main_a = max(by_file[index_of[a]], key=lambda n: size[find(n)])
+        main_b = max(by_file[index_of[b]], key=lambda n: size[find(n)])
+        union(main_a, main_b)
+
+    # what is left alone goes with the rest of its file, then with the rest of its directory
+    new_paths = {i: new_path for i, old_path, new_path, status in files}
+    for key in (lambda i: i, lambda i: os.path.dirname(new_paths[i])):
+        alone = {}
+        for root, members in groups().items():
+            keys = {key(nodes[n][0]) for n in members}
+            if len(keys) == 1:
+                alone.setdefault(keys.pop(), []).append(root)
+        for roots in alone.values():
+            for root in roots[1:]:
+                union(roots[0], root)
+
+    proposals = []
+    for members in sorted(groups().values()):
+        proposal = {}
+        for n in members:
+            i, h = nodes[n]
+            proposal.setdefault(i, []).append(h)
+        for i, numbers in proposal.items():
+            if len(numbers) == len(by_file[i]):
+                proposal[i] = None
+        proposals.append(proposal)
+    return proposals
+
+
+class HunkIndex:
+    # every hunk of the remaining changes with its file, directory, function context and changed
+    # identifiers, grouped into proposed stages. Built in the background: the hunks are read by a
+    # process pool while this thread walks the history for files which changed together
+    def __init__(self, repo_path, deltas, history_from, previous=None):
+        self.files = [(i, d.old_file.path, d.new_file.path, d.status) for i, d in enumerate(deltas)]
+        self.blobs = {i: (str(d.old_file.id) if d.old_file.id != NULL_OID else None,
+                          str(d.new_file.id) if d.new_file.id != NULL_OID else None) for i, d in enumerate(deltas)}
+        self.by_blobs = {}  # hunks of the files read so far by their (old blob, new blob)
+        # files the last stage did not touch are not read again
+        known = previous.by_blobs if previous and previous.done.is_set() and previous.error is None else {}
+        carried = {i: known[pair] for i, pair in self.blobs.items() if pair in known}
+        blobs = [(i, old, new) for i, (old, new) in self.blobs.items() if i not in carried]
+        self.proposals = None
+        self.error = None
+        self.indexed = 0
+        self.cancelled = False
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(repo_path, blobs, carried, history_from), daemon=True)
+        self.thread.start()
+
+    def run(self, repo_path, blobs, carried, history_from):
+        try:
+            with profile("hunk index"):
+                hunks = {}
+                self.collect(hunks, carried.items())
+                tasks = [blobs[n:n + HUNK_INDEX_CHUNK] for n in range(0, len(blobs), HUNK_INDEX_CHUNK)]
+                repo = pygit2.Repository(repo_path)
+                paths = {path for f in self.files for path in f[1:3]}
+                if HUNK_INDEX_WORKERS > 1 and len(tasks) > 1:
+                    with ProcessPoolExecutor(HUNK_INDEX_WORKERS) as pool:
+                        futures = [pool.submit(index_hunks, repo_path, task) for task in tasks]
+                        cochange = cochange_counts(repo, history_from, paths, self.is_cancelled)
+                        for future in futures:
+                            if self.cancelled:
+                                pool.shutdown(cancel_futures=True)
+                                return
+                            self.collect(hunks, future.result())
+                else:
+                    cochange = cochange_counts(repo, history_from, paths, self.is_cancelled)
+                    for task in tasks:
+                        if self.cancelled:
+                            return
+                        self.collect(hunks, index_hunks(repo_path, task))
+                self.proposals = group_hunks(self.files, hunks, cochange)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def collect(self, hunks, indexed):
+        for i, file_hunks in indexed:
+            hunks[i] = file_hunks
+            self.by_blobs[self.blobs[i]] = file_hunks
+        self.indexed += len(indexed)
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def message_box(stdscr, title, lines, keys=None):
+    # modal box with a list of messages, closed by any key or one of `keys`. Returns the key pressed
+    height = min(len(lines) + 4, curses.LINES - 2)
+    width = min(max([len(title)] + [len(l) for l in lines]) + 4, curses.COLS - 2)
+    box = curses.newwin(height, width, (curses.LINES - height) // 2, (curses.COLS - width) // 2)
+    box.box()
+    box.addstr(0, 2, title[:width-4], curses.A_BOLD)
+    for i, line in enumerate(lines[:height-4]):
+        box.addstr(i + 2, 2, line[:width-4])
+    box.refresh()
+    while True:
+        key = stdscr.getch()
+        if not keys or key in keys:
+            break
+    del box
+    return key
+
+
+def index_conflicts(index):
+    # list of (path, entry of the remaining changes) for conflicting paths
+    conflicts = []
+    for ancestor, ours, theirs in index.conflicts:
+        conflicts.append(((theirs or ours or ancestor).path, theirs))
+    return conflicts
+
+
+def take_theirs(index, conflicts):
+    for path, theirs in conflicts:
+        del index.conflicts[path]
+        if theirs:
+            index.add(theirs)
+
+
+def resolve_conflicts(stdscr, index, logger):
+    # remaining changes do not fit on top of the stage, let the user either take the version
+    # of the remaining changes or leave the stage to adjust the selection
+    conflicts = index_conflicts(index)
+    logger.debug("conflicts: {}".format(", ".join(path for path, theirs in conflicts)))
+
+    lines = ["C " + path for path, theirs in conflicts]
+    lines += ["", "[t] take the remaining changes version   [a] leave the stage"]
+    key = message_box(stdscr, "Remaining changes conflict with the stage", lines, [ord('t'), ord('a'), 113])
+    if key != ord('t'):
+        return False
+
+    take_theirs(index, conflicts)
+    return True
+
+
+def ai_patch_items(cfg):
+    # selected changes of the stage for the AI prompt, list of (is_partial, text)
+    items = []
+    for c in cfg:
+        is_partial, pp = c.squeze()
+        pp = pp.strip(" \t\n")
+        if len(pp) > 0:
+            items.append((is_partial, pp))
+    return items
+
+
+def ai_format_items(items):
+    patches = ""
+    for is_partial, pp in items:
+        if is_partial:
+            patches += "```diff\n{}\n```".format(json.dumps(pp));
+        else:
+            patches += "```{}```\n".format(json.dumps(pp));
+    return patches
+
+
+def ai_messages(description, patches):
+    if description:
+        request = "Please provide description for the patch considering the short description.\n\n{}\n{}\n".format(json.dumps(description), patches)
+    else:
+        request = "Please provide description for the patch.\n\n{}\n".format(patches)
+    return [
+        {"role": "system", "content": AI_SYSTEM_PROMPT},
+        {"role": "user", "content": request},
+    ]
+
+
+def ai_map_messages(part, parts, patches):
+    request = "This is part {} of {} of a bigger patch. Please describe this part briefly, it will be merged with descriptions of the other parts.\n\n{}\n".format(part, parts, patches)
+    return [
+        {"role": "system", "content": AI_SYSTEM_PROMPT},
+        {"role": "user", "content": request},
+    ]
+
+
+def ai_reduce_messages(description, summaries):
+    parts = "\n\n".join("Part {}:\n{}".format(i + 1, text) for i, text in enumerate(summaries))
+    if description:
+        request = "The patch was too big, so its parts were described separately. Please provide description for the whole patch from descriptions of its parts considering the short description.\n\n{}\n{}\n".format(json.dumps(description), parts)
+    else:
+        request = "The patch was too big, so its parts were described separately. Please provide description for the whole patch from descriptions of its parts.\n\n{}\n".format(parts)
+    return [
+        {"role": "system", "content": AI_SYSTEM_PROMPT},
+        {"role": "user", "content": request},
+    ]
+
+
+def estimate_tokens(text):
+    # rough estimate good enough for budgeting, ~4 characters per token
+    return len(text) // 4 + 1
+
+
+def messages_tokens(messages):
+    return sum(estimate_tokens(m["content"]) for m in messages)
+
+
+def ai_chunks(items, budget):
+    # pack items into chunks of at most `budget` tokens, items which are too big alone are split by lines
+    pieces = []
+    for is_partial, pp in items:
+        if estimate_tokens(ai_format_items([(is_partial, pp)])) <= budget:
+            pieces.append((is_partial, pp))
+            continue
+        piece = []
+        size = 0
+        for line in pp.splitlines():
+            # json escaping may grow the text a bit, keep some reserve
+            line_size = estimate_tokens(line) * 5 // 4 + 1
+            if piece and size + line_size > budget:
+                pieces.append((is_partial, "\n".join(piece)))
+                piece = []
+                size = 0
+            piece.append(line)
+            size += line_size
+        if piece:
+            pieces.append((is_partial, "\n".join(piece)))
+
+    chunks = []
+    chunk = []
+    size = 0
+    for item in pieces:
+        item_size = estimate_tokens(ai_format_items([item]))
+        if chunk and size + item_size > budget:
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+        chunk.append(item)
+        size += item_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def ai_cut(text, budget):
+    # the beginning of `text` which takes at most `budget` tokens as an item of a chunk
+    while text and estimate_tokens(ai_format_items([(False, text)])) > budget:
+        text = text[:len(text) * 3 // 4]
+    return text
+
+
+def ai_min_token_budget():
+    # the prompts alone take this much, a chunk has to leave room for two summaries next to them
+    prompt = max(messages_tokens(ai_map_messages(0, 0, "")), messages_tokens(ai_reduce_messages("", [""])))
+    return prompt + 2 * estimate_tokens(ai_format_items([(False, "")]))
+
+
+class OpenAIBackend:
+    # the client stack and the token are loaded with the first request, a session which never asks
+    # for a description does not import openai, httpx and pydantic at all
+    def __init__(self, token_path):
+        self.token_path = token_path
+        self.model = "openai/" + OAI_MODEL     # what made the answers, for the AI cache
+        self.client = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        with self.lock:
+            if self.client is None:
+                from openai import OpenAI
+                with open(self.token_path, "r") as oai_file:
+                    tok = oai_file.readline().strip()
+                self.client = OpenAI(api_key = tok)
+            return self.client
+
+    def complete(self, messages, on_text=None, cancelled=None):
+        client = self.connect()
+        if on_text is None:
+            response = client.chat.completions.create(model=OAI_MODEL, messages=messages, temperature=0)
+            return response.choices[0].message.content if response and len(response.choices) > 0 else ""
+
+        text = ""
+        stream = client.chat.completions.create(model=OAI_MODEL, messages=messages, temperature=0, stream=True)
+        for chunk in stream:
+            if cancelled and cancelled():
+                stream.close()
+                break
+            if chunk.choices and chunk.choices[0].delta.content:
+                text += chunk.choices[0].delta.content
+                on_text(chunk.choices[0].delta.content)
+        return text
+
+
+class LocalBackend:
+    # offline stand-in for the AI service: describes the request by counting what is in it.
+    # Deterministic, used for tests and for trying the pipeline out without a token
+    model = "local"
+
+    def complete(self, messages, on_text=None, cancelled=None):
+        request = messages[-1]["content"]
+        files = re.findall(r"\[[+-]\] ([^\s\"]+)|diff --git a/(\S+)", request)
+        files = set(a or b for a, b in files)
+        added = len(re.findall(r"(?:\\n|\")\+(?!\+\+)", request))
+        removed = len(re.findall(r"(?:\\n|\")-(?!--)", request))
+        parts = len(re.findall(r"^Part [0-9]+:$", request, re.M))
+        # descriptions of parts made by this backend are summed up
+        for a, r, f in re.findall(r"with ([0-9]+) added and ([0-9]+) removed lines(?: in \[([^\]]*)\])?", request):
+            added += int(a)
+            removed += int(r)
+            files.update(f.split(", ") if f else [])
+        files = sorted(files)
+        text = "Changeset with {} added and {} removed lines".format(added, removed)
+        if files:
+            text += " in [{}]".format(", ".join(files))
+        if parts:
+            text += ", merged from {} parts".format(parts)
+        text += "."
+        if on_text:
+            for i, word in enumerate(text.split(" ")):
+                if cancelled and cancelled():
+                    break
+                on_text((" " if i else "") + word)
+        return text
+
+
+def stage_digest(cfg):
+    # hash of the selected changes: blob ids for whole files, patch text for partial ones
+    h = hashlib.sha256()
+    for c in cfg:
+        if c.partially_selected:
+            h.update("P {}\n".format(c.delta.new_file.path).encode('utf-8'))
+            for line in c.partial_patch:
+                h.update(line.encode('utf-8', 'surrogateescape') + b"\n")
+        elif c.selected:
+            h.update("F {} {} {} {} {}\n".format(c.delta.status, c.delta.old_file.path, c.delta.old_file.id, c.delta.new_file.path, c.delta.new_file.id).encode('utf-8'))
+    return h.hexdigest()
+
+
+@contextlib.contextmanager
+def locked(path):
+    # exclusive lock between processes on the file at `path`, held for the block
+    with open(path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+class AICache:
+    # content addressed cache of AI answers, one json file per answer.
+    # Entries older than `max_age` seconds go away, then the least recently used ones until the cache fits `max_bytes`
+    def __init__(self, path, max_bytes=AI_CACHE_MAX_BYTES, max_age=AI_CACHE_MAX_AGE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+        self.stats = self.load()                        # totals of all sessions as of the last save
+        self.pending = dict.fromkeys(self.stats, 0)     # counted here since the last save
+        self.session = {"hits": 0, "misses": 0}
+
+    def load(self):
+        stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        try:
+            with open("{}/stats.json".format(self.path), "r") as f:
+                stats.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+        return stats
+
+    @staticmethod
+    def key(model, messages, description, digest):
+        h = hashlib.sha256()
+        h.update(json.dumps([model, messages, description, digest]).encode('utf-8'))
+        return h.hexdigest()
+
+    def entry(self, key):
+        return "{}/{}.json".format(self.path, key)
+
+    def get(self, key):
+        with self.lock:
+            name = self.entry(key)
+            try:
+                age = time.time() - os.stat(name).st_mtime
+                if age > self.max_age:
+                    os.remove(name)
+                    raise FileNotFoundError(name)
+                with open(name, "r") as f:
+                    text = json.load(f)["text"]
+                os.utime(name)
+            except (OSError, ValueError, KeyError):
+                self.count("misses")
+                return None
+            self.count("hits")
+            return text
+
+    def put(self, key, text):
+        with self.lock:
+            tmp = "{}.{}.tmp".format(self.entry(key), os.getpid())
+            with open(tmp, "w") as f:
+                json.dump({"model": ai_backend.model, "time": time.time(), "text": text}, f)
+            os.replace(tmp, self.entry(key))
+            self.pending["stores"] += 1
+            self.evict()
+            self.save()
+
+    def count(self, what):
+        self.pending[what] += 1
+        self.session[what] += 1
+        self.save()
+
+    def evict(self):
+        entries = []
+        now = time.time()
+        for e in os.scandir(self.path):
+            if not e.name.endswith(".json") or e.name == "stats.json":
+                continue
+            # sessions running at once share the cache, an entry may be gone already
+            with contextlib.suppress(FileNotFoundError):
+                st = e.stat()
+                if now - st.st_mtime > self.max_age:
+                    os.remove(e.path)
+                    self.pending["evictions"] += 1
+                else:
+                    entries.append((st.st_mtime, st.st_size, e.path))
+        entries.sort()
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+                self.pending["evictions"] += 1
+            total -= size
+
+    def save(self):
+        # sessions running at once share the cache, the counts of this one are added to the ones on disk
+        with locked("{}/stats.lock".format(self.path)):
+            stats = self.load()
+            for what, n in self.pending.items():
+                stats[what] += n
+            tmp = "{}/stats.json.{}.tmp".format(self.path, os.getpid())
+            with open(tmp, "w") as f:
+                json.dump(stats, f)
+            os.replace(tmp, "{}/stats.json".format(self.path))
+        self.stats = stats
+        self.pending = dict.fromkeys(stats, 0)
+
+
+class AIJob:
+    # AI description request running in a background thread, the answer is streamed into `text`.
+    # Stages bigger than the token budget are described per chunk by a pool of workers and the
+    # descriptions are then reduced into one. Answers are taken from and stored to `cache` when given
+    def __init__(self, description, items, digest, logger, cache=None):
+        self.description = description
+        self.items = items
+        self.messages = ai_messages(description, ai_format_items(items))
+        self.logger = logger
+        self.cache = cache
+        self.key = AICache.key(ai_backend.model, self.messages, description, digest) if cache else None
+        self.cached = False
+        self.progress = ""
+        self.text = ""
+        self.error = None
+        self.cancelled = False
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            if self.cache:
+                text = self.cache.get(self.key)
+                if text is not None:
+                    self.logger.debug("gpt (cached {}): {}".format(self.key, text))
+                    self.text = text
+                    self.cached = True
+                    return
+
+            with profile("ai"):
+                if messages_tokens(self.messages) <= AI_TOKEN_BUDGET:
+                    ai_backend.complete(self.messages, self.on_text, self.is_cancelled)
+                else:
+                    self.map_reduce()
+
+            self.logger.debug("gpt: {}".format(self.text))
+            if self.cache and not self.cancelled:
+                self.cache.put(self.key, self.text)
+        except Exception as e:
+            self.logger.debug("AI request failed: {}".format(e))
+            self.error = e
+        finally:
+            self.done.set()
+
+    def map_reduce(self):
+        # room left for the prompt around the chunk
+        budget = max(AI_TOKEN_BUDGET - messages_tokens(ai_map_messages(0, 0, "")), 1)
+        chunks = [ai_format_items(chunk) for chunk in ai_chunks(self.items, budget)]
+        level = 0
+        while True:
+            level += 1
+            summaries = self.summarize(chunks, level)
+            if self.cancelled:
+                return
+            messages = ai_reduce_messages(self.description, summaries)
+            if messages_tokens(messages) <= AI_TOKEN_BUDGET or len(summaries) == 1:
+                break
+            # summaries are still too big, describe them in chunks again. Summaries which fill a chunk
+            # each would never get fewer, they are cut to half a chunk so that the count halves per level
+            items = [(False, text) for text in summaries]
+            if len(ai_chunks(items, budget)) >= len(summaries):
+                items = [(False, ai_cut(text, budget // 2)) for text in summaries]
+            chunks = ["\n\n".join(text for is_partial, text in chunk) for chunk in ai_chunks(items, budget)]
+
+        self.progress = "merging {} parts".format(len(summaries))
+        ai_backend.complete(messages, self.on_text, self.is_cancelled)
+
+    def summarize(self, chunks, level):
+        done = 0
+        summaries = [None] * len(chunks)
+        self.progress = "level {}: 0/{} parts".format(level, len(chunks))
+        self.logger.debug("describing {} chunks at level {} with {} workers".format(len(chunks), level, AI_WORKERS))
+
+        def describe(i):
+            if self.cancelled:
+                return (i, "")
+            return (i, ai_backend.complete(ai_map_messages(i + 1, len(chunks), chunks[i])))
+
+        with ThreadPoolExecutor(max_workers=AI_WORKERS) as pool:
+            for i, text in pool.map(describe, range(len(chunks))):
+                summaries[i] = text
+                done += 1
+                self.progress = "level {}: {}/{} parts".format(level, done, len(chunks))
+        return summaries
+
+    def on_text(self, text):
+        self.text += text
+
+    def is_cancelled(self):
+        return self.cancelled
+
+    def cancel(self):
+        self.cancelled = True
+
+def wait_ai_job(stdscr, job):
+    # show the answer as it streams in until the job is done, returns False if the user cancelled it
+    height = min(12, curses.LINES - 2)
+    width = curses.COLS - 4
+    box = curses.newwin(height, width, (curses.LINES - height) // 2, 2)
+    stdscr.timeout(100)
+    completed = True
+    try:
+        while not job.done.is_set():
+            box.erase()
+            box.box()
+            box.addstr(0, 2, " Generating description: {} chars {}, [q] to cancel ".format(len(job.text), job.progress)[:width-4], curses.A_BOLD)
+            tail = []
+            for paragraph in job.text.splitlines():
+                tail += textwrap.wrap(paragraph, width - 4) or [""]
+            for i, line in enumerate(tail[-(height-2):]):
+                box.addstr(i + 1, 2, line)
+            box.refresh()
+
+            key = stdscr.getch()
+            if key == curses.KEY_F10 or key == 113:
+                job.cancel()
+                completed = False
+                break
+    finally:
+        stdscr.timeout(-1)
+        del box
+
+    if completed and job.error:
+        message_box(stdscr, "AI request failed", [str(job.error)])
+    return completed and job.error is None
+
+
+def wait_hunk_index(stdscr, index):
+    # progress of grouping the hunks until it is done, returns False if cancelled or failed
+    width = min(60, curses.COLS - 4)
+    box = curses.newwin(3, width, (curses.LINES - 3) // 2, (curses.COLS - width) // 2)
+    stdscr.timeout(100)
+    try:
+        while not index.done.wait(0.05):
+            box.erase()
+            box.box()
+            box.addstr(1, 2, "Grouping hunks: {}/{} files, [q] to cancel".format(index.indexed, len(index.files))[:width - 4])
+            box.refresh()
+            key = stdscr.getch()
+            if key == curses.KEY_F10 or key == 113:
+                index.cancel()
+                return False
+    finally:
+        stdscr.timeout(-1)
+        del box
+
+    if index.error:
+        message_box(stdscr, "Grouping hunks failed", [str(index.error)])
+    return index.error is None
+
+
+class CommitSeeds:
+    # original commits of the range for --per-commit. The working set is one of them, or a few
+    # consecutive ones, on top of the stages so far: its diff is all the file list, the search and
+    # the proposals ever see, no diff of the whole range is made
+    def __init__(self, repo, first, last):
+        walker = repo.walk(last, SortMode.TOPOLOGICAL | SortMode.REVERSE)
+        walker.hide(first)
+        walker.simplify_first_parent()
+        self.repo = repo
+        self.commits = [c.id for c in walker]
+        self.start = 0      # first and last commit of the working set
+        self.at = -1
+
+    @property
+    def target(self):
+        return self.commits[self.at]
+
+    def working_set(self):
+        return [self.repo[c] for c in self.commits[self.start:self.at + 1]]
+
+    def seed(self, base, upto):
+        # the remaining changes become the commits up to `upto` on top of the stage `base`
+        last = self.repo[self.commits[upto]]
+        self.at = upto
+        head = self.repo.create_commit(None, last.author, last.committer, last.message, last.tree_id, [base])
+        self.repo.references[SE_REF].set_target(head)
+        if not IN_MEMORY:
+            self.repo.reset(head, pygit2.GIT_RESET_HARD)
+        return head
+
+    def next(self, base):
+        # the next commit with changes becomes the working set, None at the end of the range
+        tree = self.repo[base].tree_id
+        for upto in range(self.at + 1, len(self.commits)):
+            if self.repo[self.commits[upto]].tree_id != tree:
+                self.start = upto
+                return self.seed(base, upto)
+        return None
+
+    def describe(self):
+        if self.start == self.at:
+            subject = self.repo[self.target].message.split("\n", 1)[0]
+            return "commit {}/{}: {}".format(self.at + 1, len(self.commits), subject)
+        return "commits {}-{}/{}".format(self.start + 1, self.at + 1, len(self.commits))
+
+
+def pick_commits(stdscr, seeds):
+    # the commits left in the range, the working set is extended up to the one picked with [enter].
+    # Returns its index or None if cancelled
+    commits = seeds.commits[seeds.start:]
+    height = min(len(commits) + 4, curses.LINES - 2)
+    width = curses.COLS - 4
+    box = curses.newwin(height, width, (curses.LINES - height) // 2, 2)
+    rows = height - 4
+    cursor = seeds.at - seeds.start
+    top = 0
+    try:
+        while True:
+            top = min(max(top, cursor - rows + 1), cursor)
+            box.erase()
+            box.box()
+            box.addstr(0, 2, " Work on the commits up to: [enter] picks, [q] cancels "[:width - 4], curses.A_BOLD)
+            for row in range(min(rows, len(commits) - top)):
+                k = top + row
+                commit = seeds.repo[commits[k]]
+                line = "[{}] {} {}".format("x" if k <= seeds.at - seeds.start else " ", commit.short_id, commit.message.split("\n", 1)[0])
+                box.addstr(row + 2, 2, line[:width - 4].ljust(width - 4), curses.A_REVERSE if k == cursor else 0)
+            box.refresh()
+
+            key = stdscr.getch()
+            if key == curses.KEY_DOWN and cursor < len(commits) - 1:
+                cursor += 1
+            elif key == curses.KEY_UP and cursor > 0:
+                cursor -= 1
+            elif key == curses.KEY_NPAGE:
+                cursor = min(cursor + rows, len(commits) - 1)
+            elif key == curses.KEY_PPAGE:
+                cursor = max(cursor - rows, 0)
+            elif key == 10:
+                return seeds.start + cursor
+            elif key == 27 or key == 113 or key == curses.KEY_F10:
+                return None
+    finally:
+        del box
+
+
 def ready_to_stage(cfg):
     items = 0
     for c in cfg:
-        items += 1 if not c.is_empty() else 0
+        items += 1 if c is not None and not c.is_empty() else 0
     return items > 0
 
 
-def main(stdscr, sd, repo, first_commit, git_se_head, local_head):
+def find_similar(diff):
+    # mark renames and copies in the diff, if asked for on the command line
+    if FIND_RENAMES is None:
+        return diff
+    flags = DiffFind.FIND_RENAMES
+    if FIND_COPIES is not None:
+        flags |= DiffFind.FIND_COPIES
+    diff.find_similar(flags=flags, rename_threshold=FIND_RENAMES,
+                      copy_threshold=FIND_COPIES if FIND_COPIES is not None else FIND_RENAMES,
+                      rename_limit=RENAME_LIMIT)
+    return diff
+
+
+def stage_diff(repo, old, new):
+    # the changes which are left to split, the file list, the search index and plans all use it
+    return find_similar(repo.diff(old, new, flags=DiffOption.SHOW_BINARY))
+
+
+def delta_key(delta):
+    # all a patch is made of, a delta with the same key after a stage has the same patch
+    return (delta.status, delta.similarity, delta.old_file.path, delta.old_file.id, delta.old_file.mode,
+            delta.new_file.path, delta.new_file.id, delta.new_file.mode)
+
+
+class StageChanges:
+    # the changes left to split, it stands in for the stage diff. The deltas come from a tree diff which
+    # skips unchanged directories and reads no file, a patch is generated when the file is opened.
+    # A stage touches a few of the files only, the patches of the others are carried over to the next one
+    def __init__(self, repo, base, rest):
+        self.repo = repo
+        self.patches = {}   # by delta_key
+        self.advance(base, rest)
+
+    def advance(self, base, rest):
+        # `rest` are the remaining changes on top of the stage `base`
+        self.diff = stage_diff(self.repo, base, rest)
+        self.deltas = list(self.diff.deltas)
+        if self.patches:
+            left = set(delta_key(d) for d in self.deltas)
+            self.patches = {key: patch for key, patch in self.patches.items() if key in left}
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def __getitem__(self, i):
+        key = delta_key(self.deltas[i])
+        patch = self.patches.get(key)
+        if patch is None:
+            patch = self.patches[key] = self.diff[i]
+        return patch
+
+
+def stage_patches(cfg):
+    # collect the selected patches of the stage and save them as a single patch file for the recreator
+    patches = [(c, c.stage_patch()) for c in cfg]
+    patches = [(c, p if p.endswith(b"\n") else p + b"\n") for c, p in patches if p]
+    if not patches:
+        return []
+
+    with open("{}/_{}.patch".format(SE_DIR, ai_chapter), "wb") as pp:
+        pp.write(b"".join(git_copy_patch(c.delta, p) for c, p in patches))
+    return patches
+
+
+def git_copy_patch(delta, patch):
+    # libgit2 leaves the copy lines out of the header of an edited copy and `git apply` of the
+    # recreator would take it for a move of the source. They are put in the way git writes them
+    if delta.status != DeltaStatus.COPIED or delta.old_file.id == delta.new_file.id:
+        return patch
+    end = patch.index(b"\n") + 1
+    lines = ["similarity index {}%".format(delta.similarity),
+             "copy from {}".format(quote_path("", delta.old_file.raw_path)),
+             "copy to {}".format(quote_path("", delta.new_file.raw_path))]
+    return patch[:end] + "".join(line + "\n" for line in lines).encode('utf-8', 'surrogateescape') + patch[end:]
+
+
+def apply_stage_patches(repo, patches, logger):
+    # libgit2 removes the source of a copy, or reads the modified one, when applying it,
+    # so copies are written out from the object database and the rest is applied.
+    # returns a list of (path, error) for files which could not be applied
+    errors = []
+    for c, p in patches:
+        if c.delta.status == DeltaStatus.COPIED:
+            try:
+                c.write_to_workdir(repo)
+            except ValueError as e:
+                logger.debug("{} failed to apply: {}".format(c.delta.new_file.path, e))
+                errors.append((c.delta.new_file.path, str(e)))
+    return errors + apply_patch_group(repo, [(c, p) for c, p in patches if c.delta.status != DeltaStatus.COPIED], logger)
+
+
+def apply_patch_group(repo, patches, logger):
+    # join the patches into a single diff and apply it to the workdir in one call.
+    # returns a list of (path, error) for files which could not be applied
+    if not patches:
+        return []
+
+    try:
+        repo.apply(pygit2.Diff.parse_diff(b"".join(p for c, p in patches)), location=ApplyLocation.WORKDIR)
+        return []
+    except pygit2.GitError as e:
+        logger.debug("stage patch failed to apply: {}".format(e))
+
+    # find out which files are to blame and apply the rest
+    errors = []
+    good = []
+    for c, p in patches:
+        path = c.delta.new_file.path
+        try:
+            repo.applies(pygit2.Diff.parse_diff(p), location=ApplyLocation.WORKDIR, raise_error=True)
+            good.append(p)
+        except pygit2.GitError as e:
+            logger.debug("{} failed to apply: {}".format(path, e))
+            errors.append((path, str(e)))
+
+    if good:
+        repo.apply(pygit2.Diff.parse_diff(b"".join(good)), location=ApplyLocation.WORKDIR)
+    return errors
+
+
+def apply_hunks(data, patch_lines):
+    # apply hunks of a unified diff (list of text lines) to the blob content `data`, returns new content
+    old = data.split(b"\n")
+    old_eof_nl = data.endswith(b"\n")
+    if old_eof_nl or not data:
+        old.pop()
+    out = []
+    pos = 0
+    in_hunk = False
+    at_eof = False
+    no_eof_nl = False
+    last = None
+
+    for line in patch_lines:
+        m = HUNK_HEADER_RE.match(line)
+        if m:
+            # empty old side of the hunk points to the line after which the new lines go
+            start = int(m.group(1)) - (0 if m.group(2) == "0" else 1)
+            if start < pos or start > len(old):
+                raise ValueError("hunk {} is out of order".format(line))
+            out.extend(old[pos:start])
+            pos = start
+            in_hunk = True
+            continue
+        if not in_hunk or not line:
+            continue
+
+        kind = line[0]
+        text = line[1:].encode('utf-8', 'surrogateescape')
+        if kind == ' ' or kind == '-':
+            if pos >= len(old) or old[pos] != text:
+                raise ValueError("context mismatch at line {}".format(pos + 1))
+            if kind == ' ':
+                out.append(text)
+                no_eof_nl = False
+            pos += 1
+            last = kind
+        elif kind == '+':
+            out.append(text)
+            no_eof_nl = False
+            last = kind
+        elif kind == '\\' and last != '-':
+            # the last line of the new side has no newline at the end
+            no_eof_nl = True
+        at_eof = pos == len(old)
+
+    out.extend(old[pos:])
+    eof_nl = not no_eof_nl if at_eof else old_eof_nl
+    if not out:
+        return b""
+    return b"\n".join(out) + (b"\n" if eof_nl else b"")
+
+
+def build_stage_tree(repo, base_commit, patches, logger):
+    # build the tree of the stage from the `base_commit` tree and selected patches
+    # without touching the workdir or the repository index.
+    # returns tree id and a list of (path, error) for files which could not be applied
+    index = pygit2.Index()
+    index.read_tree(repo.get(base_commit).peel(pygit2.Tree))
+    errors = []
+    for c, p in patches:
+        try:
+            c.add_to_tree_index(repo, index)
+        except ValueError as e:
+            logger.debug("{} failed to apply: {}".format(c.delta.new_file.path, e))
+            errors.append((c.delta.new_file.path, str(e)))
+    return (index.write_tree(repo), errors)
+
+
+class DiffConfig:
+    selected = False
+    partially_selected = False
+    delta = None
+    logger = None
+    partial_patch = None
+    lines_selected = None
+
+    def __init__(self, repo, diff, idx, delta, logger):
+        self.repo = repo
+        self.diff = diff
+        self.idx = idx
+        self.delta = delta
+        self.logger = logger
+        self._patch = None
+
+    @property
+    def patch(self):
+        # patch text is generated only when the file is opened, exported or applied
+        if self._patch is None:
+            self._patch = self.diff[self.idx]
+        return self._patch
+
+    def patch_lines(self):
+        # rows of the patch, the text of a row is decoded when it is needed
+        with profile("navigation map"):
+            return PatchLines(self.repo, self.patch, self.logger)
+
+    @property
+    def is_binary(self):
+        # deltas taken from `Diff.deltas` know whether they are binary only after the patch is generated
+        return self.patch.delta.is_binary
+
+    def marking(self):
+        if self.partially_selected:
+            return '*'
+        return '+' if self.selected else ' '
+
+    def is_empty(self):
+        return self.selected == False and self.partially_selected == False
+
+    def select(self):
+        self.selected = not self.selected
+
+    def clear(self):
+        self.selected = False
+        self.partially_selected = False
+        self.partial_patch = None
+        self.lines_selected = None
+
+    def can_select_partially(self):
+        # pure renames and copies, like empty files, have no lines to pick from
+        if self.delta.status not in PARTIAL_STATUSES or self.is_binary:
+            return False
+        context, additions, deletions = self.patch.line_stats
+        return additions + deletions > 0
+
+    def select_ex(self, stdscr, jump_rows=None):
+        if not self.can_select_partially():
+            return
+
+        self.partial_patch = partially_select(stdscr, self, self.logger, jump_rows)
+        self.partially_selected = self.partial_patch != None
+
+    def select_rows(self, rows):
+        # add change rows to the partial selection, e.g. all matches of a search
+        lines = self.patch_lines()
+        line_desc = lines.line_desc
+        if self.lines_selected is None:
+            self.lines_selected = bytearray(len(lines))
+        for row in rows:
+            self.lines_selected[row] = 1
+
+        with profile("generate patch"):
+            self.partial_patch = generate_patch(lines, self.lines_selected, line_desc, self.logger)
+        self.partially_selected = self.partial_patch != None
+
+    def select_lines(self, hunks=None, ranges=None):
+        # non-interactive partial selection: whole hunks by number (1-based) and/or ranges of changed
+        # lines, `+` lines are matched by the new file line number, `-` lines by the old one
+        lines = self.patch_lines()
+        nav_map = lines.nav_map
+        line_desc = lines.line_desc
+        lines_selected = bytearray(len(lines))
+        hunk_rows = set()
+        headers = sorted(line_desc.hunks)
+        for h in hunks or []:
+            if h < 1 or h > len(headers):
+                raise ValueError("{} has no hunk {}".format(self.delta.new_file.path, h))
+            hunk_rows.add(headers[h - 1])
+
+        for row in nav_map:
+            no = line_desc.new_line[row] or line_desc.old_line[row]
+            if line_desc.patch_header[row] in hunk_rows or any(a <= no <= b for a, b in ranges or []):
+                lines_selected[row] = 1
+
+        with profile("generate patch"):
+            self.partial_patch = generate_patch(lines, lines_selected, line_desc, self.logger)
+        self.partially_selected = self.partial_patch != None
+        self.lines_selected = lines_selected
+
+    def squeze(self, prefix=""):
+        # do not do anything if it's binary
+        if self.partially_selected and self.is_binary:
+            return (False, "")
+        is_partial = True
+        out = ""
+
+        if self.partially_selected:
+            self.logger.debug(f"{self.delta.new_file.path} is partially selected and delta status = {self.delta.status} for {self.delta.new_file.path}")
+            for line in self.partial_patch:
+                out += prefix + line + "\n"
+        elif self.selected:
+            self.logger.debug(f"{self.delta.new_file.path} is fully selected and delta status = {self.delta.status} for {self.delta.new_file.path}")
+            is_partial = False
+            if self.delta.status == DeltaStatus.DELETED:
+                out += prefix + " [-] " + self.delta.new_file.path
+            elif self.delta.status == DeltaStatus.RENAMED:
+                out += prefix + " [R] " + self.delta.old_file.path + " -> " + self.delta.new_file.path
+            elif self.delta.status == DeltaStatus.COPIED:
+                out += prefix + " [C] " + self.delta.old_file.path + " -> " + self.delta.new_file.path
+            else:
+                out += prefix + " [+] " + self.delta.new_file.path
+        self.logger.debug(f"output = [{out}]")
+        return (is_partial, out)
+
+    def export_patch(self, fil, prefix):
+        # do not do anything if it's binary
+        if self.is_binary:
+            return
+        if self.partially_selected:
+            for line in self.partial_patch:
+                fil.write("{}{}\n".format(prefix, line))
+        elif self.selected:
+            text_patch = self.patch.data.decode('utf-8', 'surrogateescape')
+            lines = text_patch.split("\n")[:-1]
+            for line in lines:
+                fil.write("{}{}\n".format(prefix, line))
+
+    def stage_patch(self):
+        # patch text which goes to the stage, None if not selected
+        if self.partially_selected:
+            return "".join("{}\n".format(line) for line in self.partial_patch).encode('utf-8', 'surrogateescape')
+        elif self.selected:
+            return self.patch.data
+        return None
+
+    def add_to_index(self, idx):
+        if self.partially_selected or self.selected:
+            if self.delta.status == DeltaStatus.RENAMED:
+                idx.remove(self.delta.old_file.path)
+            self.logger.debug(f"delta status = {self.delta.status} for {self.delta.new_file.path}")
+            if self.delta.status == DeltaStatus.DELETED:
+                idx.remove(self.delta.new_file.path)
+            else:
+                idx.add(self.delta.new_file.path)
+
+    def stage_data(self, repo):
+        # content of the file in the stage, taken from the object database
+        delta = self.delta
+        if not self.partially_selected:
+            return repo[delta.new_file.id].data
+        old_data = repo[delta.old_file.id].data if delta.status != DeltaStatus.ADDED else b""
+        return apply_hunks(old_data, self.partial_patch)
+
+    def write_to_workdir(self, repo):
+        path = os.path.join(repo.workdir, self.delta.new_file.path)
+        data = self.stage_data(repo)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        if self.delta.new_file.mode == pygit2.GIT_FILEMODE_BLOB_EXECUTABLE:
+            os.chmod(path, 0o755)
+
+    def add_to_tree_index(self, repo, idx):
+        # same as add_to_index, but takes the content from the object database instead of the workdir
+        if not self.partially_selected and not self.selected:
+            return
+        delta = self.delta
+        self.logger.debug(f"delta status = {delta.status} for {delta.new_file.path} (in-memory)")
+        if delta.status == DeltaStatus.RENAMED:
+            idx.remove(delta.old_file.path)
+        if delta.status == DeltaStatus.DELETED:
+            idx.remove(delta.new_file.path)
+        elif self.partially_selected:
+            blob = repo.create_blob(self.stage_data(repo))
+            idx.add(pygit2.IndexEntry(delta.new_file.path, blob, delta.new_file.mode))
+        else:
+            idx.add(pygit2.IndexEntry(delta.new_file.path, delta.new_file.id, delta.new_file.mode))
+
+    def selection_record(self, i):
+        # the selection as the journal keeps it, partial selections as ranges of selected rows
+        rows = row_ranges(self.lines_selected) if self.partially_selected else []
+        return {"file": i, "path": self.delta.new_file.path, "selected": self.selected, "rows": rows}
+
+    def restore(self, record):
+        self.selected = record["selected"]
+        if record["rows"]:
+            lines = self.patch_lines()
+            self.lines_selected = bytearray(len(lines))
+            for first, last in record["rows"]:
+                self.lines_selected[first:last + 1] = b"\x01" * (last + 1 - first)
+            with profile("generate patch"):
+                self.partial_patch = generate_patch(lines, self.lines_selected, lines.line_desc, self.logger)
+            self.partially_selected = self.partial_patch != None
 
+    def record_add(self):
+        if not self.partially_selected and not self.selected:
+            return
+        if self.delta.status == DeltaStatus.RENAMED:
+            recreator_file.write("git add {}/{}\n".format(WORK_DIR, self.delta.old_file.path))
+        recreator_file.write("git add {}/{}\n".format(WORK_DIR, self.delta.new_file.path))
+
+
+def setup_logger():
     logger = logging.getLogger(__package__)
     logger.setLevel(logging.DEBUG)
     console_handler = logging.FileHandler("{}/git-se.log".format(SE_DIR))
@@ -369,6 +2246,260 @@ def main(stdscr, sd, repo, first_commit, git_se_head, local_head):
                                   datefmt='%Y-%m-%d %H:%M:%S')
     console_handler.setFormatter(formatter)
     logger.addHandler(console_handler)
+    return logger
+
+
+def build_stage(repo, stage_cfg, first_commit, git_se_head, logger):
+    # apply the selection on top of `first_commit` and pick the remaining changes on top of the stage,
+    # "theirs" wins like with `git cherry-pick -X theirs`. No rename detection, as with cherry-pick a stage
+    # that takes only the new side of a move must not conflict with the move itself
+    # returns (selected patches, stage tree, apply errors, index of the remaining changes)
+    commit = pygit2.Oid(hex = first_commit)
+    with profile("apply"):
+        selected_patches = stage_patches(stage_cfg)
+        if IN_MEMORY:
+            stage_tree, apply_errors = build_stage_tree(repo, commit, selected_patches, logger)
+        else:
+            # now checkout the starting reference
+            repo.reset(commit, pygit2.GIT_RESET_HARD)
+            apply_errors = apply_stage_patches(repo, selected_patches, logger)
+
+    if not IN_MEMORY:
+        with profile("index"):
+            # add to index
+            index = repo.index
+            for c in stage_cfg:
+                c.add_to_index(index)
+            index.write()
+            stage_tree = index.write_tree()
+
+    with profile("cherry-pick"):
+        rest_index = repo.merge_trees(commit, stage_tree, repo.get(git_se_head).tree_id, favor=MergeFavor.THEIRS, flags=0)
+    return (selected_patches, stage_tree, apply_errors, rest_index)
+
+
+def wrap_description(text):
+    # first paragraph is the subject, the rest is wrapped at 80 columns
+    p_num = 0
+    wrapped = ""
+    for p_line in text.split('\n'):
+        p_line_c = p_line.strip(" \t\n")
+        if len(p_line_c) > 0:
+            if p_num == 0:
+                wrapped += p_line_c + "\n"
+            else:
+                wrapped += "\n"
+                wrapped += "\n".join(textwrap.wrap(p_line_c, 80, break_long_words=False, break_on_hyphens=False))
+                wrapped += "\n"
+            p_num += 1
+    return wrapped
+
+
+def record_stage(stage_cfg, selected_patches, description):
+    # write the stage into the recreator script and the AI prompt file
+    global ai_chapter
+
+    recreator_file.write("cat << 'EOF' > {}/git-se._stage_desc_clean.txt\n".format(SE_DIR))
+    recreator_file.write("{}\n".format(wrap_description(description)))
+    recreator_file.write("EOF\n")
+
+    if selected_patches:
+        recreator_file.write("git apply -p1 {}/_{}.patch\n".format(SE_DIR, ai_chapter))
+    for c in stage_cfg:
+        c.record_add()
+    ai_file.write("\n## {}. {}\n\n".format(ai_chapter, description))
+
+    ai_chapter += 1
+    for c in stage_cfg:
+        is_partial, pp = c.squeze()
+        pp = pp.strip(" \t\n")
+        if len(pp)>0 and is_partial:
+            ai_file.write("```diff\n")
+            ai_file.write(f"{pp}\n")
+            ai_file.write("```\n")
+    all_non_partials = ""
+    for c in stage_cfg:
+        is_partial, pp = c.squeze()
+        pp = pp.strip(" \t\n")
+        if len(pp)>0 and not is_partial:
+            all_non_partials += pp + "\n"
+
+    if len(all_non_partials)>0:
+        ai_file.write("\n### File changes\n```\n")
+        ai_file.write(f"{all_non_partials}\n")
+        ai_file.write("```\n")
+
+    ai_file.write("\n")
+
+    recreator_file.write("git commit -F {}/git-se._stage_desc_clean.txt\n".format(SE_DIR))
+
+
+def commit_stage(repo, stage_tree, rest_index, first_commit, git_se_head, local_head, message):
+    # commit the stage and the remaining changes on top of it.
+    # returns (stage commit, new git-se head), the head is None when nothing is left.
+    # With --per-commit the stage finishes the working set when it reaches its last commit,
+    # the next original commit gets seeded on top of it then
+    with profile("commit"):
+        author = pygit2.Signature('Git Se', 'gitse@gitse.se')
+        committer = pygit2.Signature('Git Se', 'gitse@gitse.se')
+        commit = pygit2.Oid(hex = first_commit)
+
+        if IN_MEMORY:
+            # the branch points to the remaining changes, so the stage can not advance it directly
+            new_git_se_head = repo.create_commit(None, author, committer, message, stage_tree, [commit])
+            repo.references[SE_REF].set_target(new_git_se_head)
+        else:
+            ref = repo.head.name
+            parents = [repo.head.target]
+            new_git_se_head = repo.create_commit(ref, author, committer, message, stage_tree, parents)
+
+        # check if we finish work?
+        target = commit_seeds.target if commit_seeds else local_head
+        if repo.get(new_git_se_head).tree_id == repo.get(target).tree_id:
+            return (new_git_se_head, commit_seeds.next(new_git_se_head) if commit_seeds else None)
+
+        # commit the remaining changes on top of the stage
+        remainder = repo.get(git_se_head)
+        rest_tree = rest_index.write_tree(repo)
+        git_se_head = repo.create_commit(SE_REF, remainder.author, remainder.committer, remainder.message, rest_tree, [new_git_se_head])
+        if not IN_MEMORY:
+            repo.reset(git_se_head, pygit2.GIT_RESET_HARD)
+        return (new_git_se_head, git_se_head)
+
+
+def fi_signature(kind, sig):
+    offset = "{}{:02d}{:02d}".format("-" if sig.offset < 0 else "+", abs(sig.offset) // 60, abs(sig.offset) % 60)
+    return "{} {} <{}> {} {}\n".format(kind, sig.name, sig.email, sig.time, offset).encode('utf-8')
+
+
+def fi_path(raw_path):
+    # fast-import reads C-quoted paths like the ones of patch headers
+    return quote_path("", raw_path)
+
+
+def record_replay(repo, commit_id):
+    # append the stage commit to the fast-import stream. Blobs are inlined and the signatures
+    # are kept, so the replay gives exactly the same commits without any patch files around
+    commit = repo[commit_id]
+    diff = find_similar(repo.diff(commit.parents[0], commit, flags=DiffOption.SHOW_BINARY))
+
+    replay_file.write("commit {}\n".format(REPLAY_REF).encode('utf-8'))
+    replay_file.write(fi_signature("author", commit.author))
+    replay_file.write(fi_signature("committer", commit.committer))
+    replay_file.write("data {}\n".format(len(commit.raw_message)).encode('utf-8'))
+    replay_file.write(commit.raw_message + b"\n")
+
+    # deletions first, a path can be the source of one rename and the target of another
+    for delta in diff.deltas:
+        if delta.status == DeltaStatus.DELETED or delta.status == DeltaStatus.RENAMED:
+            replay_file.write("D {}\n".format(fi_path(delta.old_file.raw_path)).encode('utf-8'))
+    for delta in diff.deltas:
+        if delta.status == DeltaStatus.DELETED:
+            continue
+        mode = delta.new_file.mode
+        path = fi_path(delta.new_file.raw_path)
+        # a moved or copied blob is already in the parent, so it goes by its sha instead of inline data
+        moved = (delta.status == DeltaStatus.RENAMED or delta.status == DeltaStatus.COPIED) and delta.old_file.id == delta.new_file.id
+        if mode == pygit2.GIT_FILEMODE_COMMIT or moved:
+            replay_file.write("M {:o} {} {}\n".format(mode, delta.new_file.id, path).encode('utf-8'))
+            continue
+        data = repo[delta.new_file.id].data
+        replay_file.write("M {:o} inline {}\ndata {}\n".format(mode, path, len(data)).encode('utf-8'))
+        replay_file.write(data + b"\n")
+    replay_file.write(b"\n")
+
+
+class Journal:
+    # append-only log of the session in `.git-se/journal.jsonl`: how it was started, every change of
+    # the selection and every committed stage. A record is on disk before the session goes on
+    def __init__(self, path, mode="a"):
+        self.file = open(path, mode)
+
+    def write(self, event, **fields):
+        record = {"event": event}
+        record.update(fields)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def read(path):
+        # records of the last session and the size of the journal up to the last complete record,
+        # a line torn by a crash is left out
+        records = []
+        size = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                size += len(line)
+                if record.get("event") == "start":
+                    records = []
+                records.append(record)
+        return (records, size)
+
+
+def resume_point(path):
+    # (start record, record of the last committed stage, seeded commits or the start one,
+    # selections made since by file index, size of the journal without a torn tail)
+    records, size = Journal.read(path)
+    if not records or records[0]["event"] != "start":
+        raise ValueError("no session to resume in {}".format(path))
+    last = 0
+    for n, record in enumerate(records):
+        if record["event"] in ("stage", "seed"):
+            last = n
+    if records[last]["git_se_head"] is None:
+        raise ValueError("the last session has staged all changes, nothing to resume")
+    selections = {r["file"]: r for r in records[last + 1:] if r["event"] == "select"}
+    return (records[0], records[last], selections, size)
+
+
+def row_ranges(lines_selected):
+    # selected rows as [first, last] ranges
+    ranges = []
+    row = lines_selected.find(1)
+    while row >= 0:
+        end = lines_selected.find(0, row)
+        if end < 0:
+            end = len(lines_selected)
+        ranges.append([row, end - 1])
+        row = lines_selected.find(1, end)
+    return ranges
+
+
+def output_offsets():
+    # sizes of the session outputs, a resumed session cuts off whatever an unfinished stage wrote
+    for f in (ai_file, recreator_file, replay_file):
+        f.flush()
+    return {"ai": ai_file.tell(), "recreator": recreator_file.tell(), "replay": replay_file.tell()}
+
+
+def journal_select(i, c):
+    if journal:
+        journal.write("select", **c.selection_record(i))
+
+
+def journal_stage(commit_id, git_se_head, event="stage"):
+    # the stage is committed and recorded, `git_se_head` is None when nothing is left.
+    # A "seed" event has the remaining changes of more original commits on top of `commit_id`
+    if journal:
+        fields = {}
+        if commit_seeds:
+            fields["working_set"] = [commit_seeds.start, commit_seeds.at]
+        journal.write(event, chapter=ai_chapter, commit=str(commit_id),
+                      git_se_head=str(git_se_head) if git_se_head else None, outputs=output_offsets(), **fields)
+
+
+def main(stdscr, sd, repo, first_commit, git_se_head, local_head, selections=None):
+    logger = setup_logger()
 
     logger.debug("git-se starting up!!")
 
@@ -406,122 +2537,107 @@ def main(stdscr, sd, repo, first_commit, git_se_head, local_head):
     box = main_box()
 
     pos = 0
-    cfg = []
-
-    class DiffConfig:
-        selected = False
-        partially_selected = False
-        patch = None
-        logger = None
-        partial_patch = None
-
-        def __init__(self, p, logger):
-            self.patch = p
-            self.logger = logger
 
-        def marking(self):
-            if self.partially_selected:
-                return '*'
-            return '+' if self.selected else ' '
-
-        def is_empty(self):
-            return self.selected == False and self.partially_selected == False
-
-        def select(self):
-            self.selected = not self.selected
-
-        def select_ex(self):
-            if self.patch.delta.status != DeltaStatus.MODIFIED and self.patch.delta.status != DeltaStatus.ADDED:
-                return
-            if self.patch.delta.is_binary:
-                return
-
-            self.partial_patch = partially_select(stdscr, self, self.logger)
-            self.partially_selected = self.partial_patch != None
-
-        def squeze(self, prefix=""):
-            # do not do anything if it's binary
-            if self.patch.delta.is_binary and self.partially_selected:
-                return (False, "")
-            is_partial = True
-            out = ""
-
-            if self.partially_selected:
-                self.logger.debug(f"{self.patch.delta.new_file.path} is partially selected and delta status = {self.patch.delta.status} for {self.patch.delta.new_file.path}")
-                for line in self.partial_patch:
-                    out += prefix + line + "\n"
-            elif self.selected:
-                self.logger.debug(f"{self.patch.delta.new_file.path} is fully selected and delta status = {self.patch.delta.status} for {self.patch.delta.new_file.path}")
-                is_partial = False
-                if self.patch.delta.status == DeltaStatus.DELETED:
-                    out += prefix + " [-] " + self.patch.delta.new_file.path
-                else:
-                    out += prefix + " [+] " + self.patch.delta.new_file.path
-            self.logger.debug(f"output = [{out}]")
-            return (is_partial, out)
-
-        def export_patch(self, fil, prefix):
-            # do not do anything if it's binary
-            if self.patch.delta.is_binary:
-                return
-            if self.partially_selected:
-                for line in self.partial_patch:
-                    fil.write("{}{}\n".format(prefix, line))
-            elif self.selected:
-                text_patch = self.patch.data.decode('utf-8')
-                lines = text_patch.splitlines()
-                for line in lines:
-                    fil.write("{}{}\n".format(prefix, line))
-
-        def apply_patch(self, idx, workdir):
-            do_patch = False
-            if self.partially_selected:
-                with open("{}/_{}_{}.patch".format(SE_DIR, ai_chapter, idx), "w") as pp:
-                    for line in self.partial_patch:
-                        pp.write("{}\n".format(line))
-                    do_patch = True
-            elif self.selected:
-                with open("{}/_{}_{}.patch".format(SE_DIR, ai_chapter, idx), "w") as pp:
-                    text_patch = self.patch.data.decode('utf-8')
-                    lines = text_patch.splitlines()
-                    for line in lines:
-                        pp.write("{}\n".format(line))
-                    do_patch = True
-
-            if do_patch:
-                subprocess.run(["git", "apply", "-p1", "{}/_{}_{}.patch".format(SE_DIR, ai_chapter, idx)], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
-                recreator_file.write("git apply -p1 {}/_{}_{}.patch\n".format(SE_DIR, ai_chapter, idx))
-
-        def add_to_index(self, idx):
-            if self.partially_selected or self.selected:
-                if self.patch.delta.new_file.path != self.patch.delta.old_file.path:
-                    if self.patch.delta.status == DeltaStatus.DELETED:
-                        idx.remove(self.patch.delta.old_file.path)
-                    else:
-                        idx.add(self.patch.delta.old_file.path)
-                    recreator_file.write("git add {}/{}\n".format(WORK_DIR, self.patch.delta.old_file.path))
-                self.logger.debug(f"delta status = {self.patch.delta.status} for {self.patch.delta.new_file.path}")
-                if self.patch.delta.status == DeltaStatus.DELETED:
-                    idx.remove(self.patch.delta.new_file.path)
-                else:
-                    idx.add(self.patch.delta.new_file.path)
-                recreator_file.write("git add {}/{}\n".format(WORK_DIR, self.patch.delta.new_file.path))
+    def get_cfg(i):
+        # per-file state is created only once the file shows up or gets selected
+        if cfg[i] is None:
+            cfg[i] = DiffConfig(repo, sd, i, deltas[i], logger)
+        return cfg[i]
+
+    def search(value):
+        # incremental search, the file list follows the matches as the query is typed
+        nonlocal matches, pos, top, search_index, last_query
+        if search_index is None:
+            search_index = SearchIndex(repo.path, first_commit, git_se_head, len(deltas))
+        complete = search_index.is_complete()
+        if (value, search_index.indexed) != last_query[:2]:
+            query, indexed, was_complete = last_query
+            narrow = was_complete and query and query in value
+            matches = search_index.query(value, list(matches) if narrow else None)
+            last_query = (value, search_index.indexed, complete)
+            if matches:
+                pos = next_match(pos - 1, 1)
+            top = render_file_list(box, deltas, cfg, top, pos, matches)
+        status = "{} lines in {} files".format(sum(len(rows) for rows in matches.values()), len(matches)) if value else ""
+        if not complete:
+            status += " (indexing {}/{})".format(search_index.indexed, len(deltas))
+        return status + " "
+
+    def propose(n):
+        # the proposed stage replaces the selection, it is committed with [F2] as it is or adjusted first
+        nonlocal pos
+        for i, c in enumerate(cfg):
+            if c is not None and not c.is_empty():
+                c.clear()
+                journal_select(i, c)
+        for i, numbers in hunk_index.proposals[n].items():
+            c = get_cfg(i)
+            if numbers is None or not c.can_select_partially():
+                c.selected = True
+            else:
+                c.select_lines(numbers)
+            journal_select(i, c)
+        pos = min(hunk_index.proposals[n])
+
+    def proposal_note():
+        if proposal is None:
+            if commit_seeds:
+                more = ", [C] more commits" if commit_seeds.at < len(commit_seeds.commits) - 1 else ""
+                return commit_seeds.describe() + more
+            return None
+        picked = hunk_index.proposals[proposal]
+        return "proposal {}/{}: {} files, [P] next".format(proposal + 1, len(hunk_index.proposals), len(picked))
+
+    def reload():
+        # the remaining changes are new after a stage or more seeded commits, so is the whole view.
+        # What was made of the files which did not change is taken over
+        nonlocal deltas, cfg, search_index, matches, last_query, hunk_index, proposal, pos, top
+        with profile("diff"):
+            sd.advance(first_commit, git_se_head)
+            deltas = list(sd.deltas)
+        cfg = [None] * len(deltas)
+        if search_index:
+            # search is in use, the remaining changes get indexed right away
+            search_index.cancel()
+            search_index = SearchIndex(repo.path, first_commit, git_se_head, len(deltas), search_index)
+        matches = {}
+        last_query = ("", 0, False)
+        if hunk_index:
+            # proposals are in use, the remaining changes get grouped right away
+            hunk_index.cancel()
+            hunk_index = HunkIndex(repo.path, deltas, first_commit, hunk_index)
+        proposal = None
+        logger.debug("new head = {}".format(str(git_se_head)))
+        pos = 0
+        top = 0
+
+    def next_match(i, step):
+        # next file with matches after `i` in the direction of `step`, wrapping around
+        for k in range(1, len(deltas) + 1):
+            j = (i + k * step) % len(deltas)
+            if j in matches:
+                return j
+        return pos
+
+    deltas = list(sd.deltas)
+    cfg = [None] * len(deltas)
+    for i, record in (selections or {}).items():
+        # selection of a resumed session, the stage diff is the same as before
+        if i < len(deltas) and deltas[i].new_file.path == record["path"]:
+            get_cfg(i).restore(record)
+        else:
+            logger.debug("journal selection of {} does not match the stage".format(record["path"]))
+    top = 0
+    search_index = None
+    matches = {}
+    last_query = ("", 0, False)
+    hunk_index = None
+    proposal = None
 
     quit_attempt = 0
     while True:
         # draw menu
-        start_oft = 4
-        oft = start_oft
-
-        for p in sd:
-            if (oft - start_oft) >= len(cfg):
-                cfg.append(DiffConfig(p, logger))
-
-            current_cfg = cfg[oft - start_oft]
-
-            box.addstr(oft, 1, "[{}] {}".format(current_cfg.marking(), p.delta.new_file.path), curses.color_pair(p.delta.status + (12 if pos + start_oft == oft else 0)))
-            oft = oft + 1
-
+        top = render_file_list(box, deltas, cfg, top, pos, matches, proposal_note())
 
         stdscr.refresh()
         box.refresh()
@@ -536,33 +2652,52 @@ def main(stdscr, sd, repo, first_commit, git_se_head, local_head):
         if key == curses.KEY_F2:
             if not ready_to_stage(cfg):
                 continue
+            stage_cfg = [c for c in cfg if c is not None]
             del box
 
-            with open(SE_DIR + "/git-se._stage_desc.txt", "w") as staged:
+            with open(SE_DIR + "/git-se._stage_desc.txt", "w", errors="surrogateescape") as staged:
                 staged.write("# Please describe the stage in view words, lines starting with # will be ignored\n")
                 staged.write("# Use #[no-ai] tag to skip generative AI comments\n")
                 staged.write("#\n")
-                for c in cfg:
+                if commit_seeds:
+                    for commit in commit_seeds.working_set():
+                        staged.write("# Splitting {} {}\n".format(commit.short_id, commit.message.split("\n", 1)[0]))
+                    staged.write("#\n")
+                for c in stage_cfg:
                     is_partial, pp = c.squeze("# ")
                     pp = pp.strip(" \t\n")
                     if len(pp) > 0:
                         staged.write(f"{pp}\n")
                 staged.write("\n")
 
-            subprocess.run(["nano", SE_DIR + "/git-se._stage_desc.txt"])
+            # selection is final, let the AI work while the stage is being described
+            ai_job = None
+            if ai_backend:
+                items = ai_patch_items(stage_cfg)
+                logger.debug(f"sending patches: {items}")
+                if len(items) > 0:
+                    ai_job = AIJob("", items, stage_digest(stage_cfg), logger, ai_cache)
 
-            # now checkout the starting reference
-            commit = pygit2.Oid(hex = first_commit)
-            repo.reset(commit, pygit2.GIT_RESET_HARD)
+            subprocess.run(["nano", SE_DIR + "/git-se._stage_desc.txt"])
 
             # apply patches
-            for c in range(0, len(cfg)):
-                cfg[c].apply_patch(c, repo.workdir)
+            selected_patches, stage_tree, apply_errors, rest_index = build_stage(repo, stage_cfg, first_commit, git_se_head, logger)
+            if apply_errors:
+                message_box(stdscr, "Some patches failed to apply", ["{}: {}".format(path, err) for path, err in apply_errors])
+
+            if rest_index.conflicts is not None and not resolve_conflicts(stdscr, rest_index, logger):
+                # leave the stage, selection stays as it is
+                if ai_job:
+                    ai_job.cancel()
+                if not IN_MEMORY:
+                    repo.reset(git_se_head, pygit2.GIT_RESET_HARD)
+                box = main_box()
+                continue
 
             # read text message
-            skip_generative_AI = False
+            skip_generative_AI = ai_backend is None
             com_line = ""
-            with open(SE_DIR + "/git-se._stage_desc.txt", "r") as staged:
+            with open(SE_DIR + "/git-se._stage_desc.txt", "r", errors="replace") as staged:
                 while lc := staged.readline():
                     if lc[0] != "#":
                         com_line += lc
@@ -571,42 +2706,19 @@ def main(stdscr, sd, repo, first_commit, git_se_head, local_head):
             pd_com_line = com_line.strip(" \t\n")
             logger.debug(f"comment: {pd_com_line}")
 
-            # ask AI to generate some description
-            if oai and not skip_generative_AI:
-
-                patches = ""
-                for c in cfg:
-                    is_partial, pp = c.squeze()
-                    pp = pp.strip(" \t\n")
-                    if len(pp) > 0:
-                        if is_partial:
-                            patches += "```diff\n{}\n```".format(json.dumps(pp));
-                        else:
-                            patches += "```{}```\n".format(json.dumps(pp));
-
-                logger.debug(f"sending patches: {patches}")
-
-                if len(patches) > 0:
-                    response = oai.chat.completions.create(
-                        model = OAI_MODEL,
-                        messages = [
-                            {"role": "system", "content": "You are helpful code reviewer. You explain patches and diffs in great depth using simple terms. You replace the word `patch` with a word `changeset`. You do not include the patch into the answer. You provide only generated description."},
-                            {"role": "user", "content": "Please provide description for the patch considering the short description.\n\n{}\n{}\n".format(json.dumps(pd_com_line), patches)},
-                        ],
-                        temperature=0,
-                    )
-                    if response and len(response.choices)>0:
-                        # need to format output line (max of 60 chars)
-                        logger.debug("gpt: {}".format(response.choices[0].message.content))
-                        pd_com_line += "\n\n"
-                        pd_com_line += response.choices[0].message.content
+            # pick up AI generated description
+            if ai_job and skip_generative_AI:
+                ai_job.cancel()
+            elif ai_job and wait_ai_job(stdscr, ai_job) and len(ai_job.text) > 0:
+                pd_com_line += "\n\n"
+                pd_com_line += ai_job.text
 
             if not skip_generative_AI:
-                with open(SE_DIR + "/git-se._stage_desc.txt", "w") as staged:
+                with open(SE_DIR + "/git-se._stage_desc.txt", "w", errors="surrogateescape") as staged:
                     staged.write("# Please review generated comments by AI. Lines starting with # will be ignored\n")
                     staged.write("#\n")
 
-                    for c in cfg:
+                    for c in stage_cfg:
                         is_partial, pp = c.squeze("# ")
                         pp = pp.strip(" \t\n")
                         if len(pp) > 0:
@@ -618,7 +2730,7 @@ def main(stdscr, sd, repo, first_commit, git_se_head, local_head):
                 subprocess.run(["nano", SE_DIR + "/git-se._stage_desc.txt"])
 
                 com_line = ""
-                with open(SE_DIR + "/git-se._stage_desc.txt", "r") as staged:
+                with open(SE_DIR + "/git-se._stage_desc.txt", "r", errors="replace") as staged:
                     while lc := staged.readline():
                         if lc[0] != "#":
                             com_line += lc
@@ -626,190 +2738,602 @@ def main(stdscr, sd, repo, first_commit, git_se_head, local_head):
                 pd_com_line = com_line.strip(" \t\n")
 
 
-            pd_com_line_unwrapped = pd_com_line
-            # now split pd_com_line into paragraphs
-            p_num = 0
-            pd_com_wrapped = ""
-            paragraphs = pd_com_line.split('\n')
-            for p_line in paragraphs:
-                p_line_c = p_line.strip(" \t\n")
-                if len(p_line_c) > 0:
-                    if p_num == 0:
-                        pd_com_wrapped += p_line_c + "\n"
-                    else:
-                        pd_com_wrapped += "\n"
-                        pd_com_wrapped += "\n".join(textwrap.wrap(p_line_c, 80, break_long_words=False, break_on_hyphens=False))
-                        pd_com_wrapped += "\n"
-                    p_num += 1
-
-            recreator_file.write("cat << 'EOF' > {}/git-se._stage_desc_clean.txt\n".format(SE_DIR))
-            recreator_file.write("{}\n".format(pd_com_wrapped))
-            recreator_file.write("EOF\n")
-
-            global ai_chapter
-            ai_file.write("\n## {}. {}\n\n".format(ai_chapter, pd_com_line_unwrapped))
-
-            ai_chapter += 1
-            for c in cfg:
-                is_partial, pp = c.squeze()
-                pp = pp.strip(" \t\n")
-                if len(pp)>0 and is_partial:
-                    ai_file.write("```diff\n")
-                    ai_file.write(f"{pp}\n")
-                    ai_file.write("```\n")
-            all_non_partials = ""
-            for c in cfg:
-                is_partial, pp = c.squeze()
-                pp = pp.strip(" \t\n")
-                if len(pp)>0 and not is_partial:
-                    all_non_partials += pp + "\n"
-
-            if len(all_non_partials)>0:
-                ai_file.write("\n### File changes\n```\n")
-                ai_file.write(f"{all_non_partials}\n")
-                ai_file.write("```\n")
-
-            ai_file.write("\n")
-
-            index = repo.index
-            author = pygit2.Signature('Git Se', 'gitse@gitse.se')
-            committer = pygit2.Signature('Git Se', 'gitse@gitse.se')
-
-            # add to index
-            for c in cfg:
-                c.add_to_index(index)
-
-            recreator_file.write("git commit -F {}/git-se._stage_desc_clean.txt\n".format(SE_DIR))
-
-            index.write()
-
-            tree = index.write_tree()
-            ref = repo.head.name
-            parents = [repo.head.target]
-            new_git_se_head = repo.create_commit(ref, author, committer, com_line, tree, parents)
-
-            # check if we finish work?
-            local_sd = repo.diff(new_git_se_head, local_head)
+            record_stage(stage_cfg, selected_patches, pd_com_line)
 
-            if len(local_sd) == 0:
+            new_git_se_head, git_se_head = commit_stage(repo, stage_tree, rest_index, first_commit, git_se_head, local_head, com_line)
+            record_replay(repo, new_git_se_head)
+            journal_stage(new_git_se_head, git_se_head)
+            if profiler:
+                profiler.flush(ai_chapter - 1)
+            if git_se_head is None:
                 break
 
-            # now cherry pick the final commit
-            # git cherry-pick --strategy=recursive -X theirs e6cc5b0
-            # logger.debug("git cherry-pick --strategy=recursive -X theirs {}"
-            proc = subprocess.run(["git", "cherry-pick", "-X", "theirs", str(git_se_head)], stdout = subprocess.DEVNULL)
-            if proc.returncode != 0:
-                logger.debug("subprocess ended [{}]".format(proc.returncode))
-                logger.debug("command: git cherry-pick -X theirs {}".format(str(git_se_head)))
-                raise Exception("cherry failed")
-
-            del repo
-            repo = pygit2.Repository(repo_path)
-            sd = repo.diff(new_git_se_head, repo.head, flags=DiffOption.SHOW_BINARY)
-            cfg = []
-            git_se_head = repo.revparse_single('HEAD').id
             first_commit = str(new_git_se_head)
-            logger.debug("new head = {}".format(str(git_se_head)))
-            pos = 0
+            reload()
 
             stdscr.keypad( 1 )
             box = main_box()
 
+        page = list_page_size(box)
+
         if key == curses.KEY_DOWN:
-            if pos<len(sd)-1:
+            if pos<len(deltas)-1:
                 pos += 1
 
         if key == curses.KEY_UP:
             if pos>0:
                 pos -= 1
 
-        if key == 32:
-            cfg[pos].select()
-
-        if key == 10:
-            cfg[pos].select_ex()
-            box.touchwin()
-
-# parse command line options
-parser = argparse.ArgumentParser(description='Git split-explain tool')
-parser.add_argument('start commit', metavar='S', type=str, nargs=1,
-                    help='start commit (end commit will be HEAD)')
-parser.add_argument('-e', metavar='E', type=str,
-                    help='end commits', default='HEAD')
-parser.add_argument('-r', metavar='R', type=str, help='repository path', default='.')
-args = parser.parse_args()
-
-first_commit = getattr(args, 'start commit')[0]
-last_commit = args.e
-repo_path = args.r
-
+        if key == curses.KEY_NPAGE:
+            pos = min(pos + page, len(deltas) - 1)
 
-repo = pygit2.Repository(repo_path)
+        if key == curses.KEY_PPAGE:
+            pos = max(pos - page, 0)
 
-WORK_DIR = repo.workdir
-SE_DIR = "{}/{}".format(repo.workdir, SE_DIR)
-
-pathlib.Path(SE_DIR).mkdir(parents=True, exist_ok=True)
-
-ai_file = open("{}/{}".format(SE_DIR, AI_PROMPT_FILENAME), "w")
-recreator_file = open("{}/git-se.recreator.sh".format(SE_DIR), "w")
-
-recreator_branch = "git-se/{}/recreator".format(first_commit)
-
-recreator_file.write("#!/usr/bin/env bash\n\n")
-
-recreator_file.write("RECREATOR_BRANCH=\"{}\"\n".format(recreator_branch))
-recreator_file.write("if [ -n \"$1\" ]; then\n")
-recreator_file.write("    RECREATOR_BRANCH=\"$1\"\n")
-recreator_file.write("fi\n")
-recreator_file.write(f"pushd {WORK_DIR}\n")
-recreator_file.write("git branch -q -D \"${RECREATOR_BRANCH}\"\n")
-recreator_file.write("git branch \"${{RECREATOR_BRANCH}}\" {}\n".format(first_commit))
-recreator_file.write("git checkout \"${RECREATOR_BRANCH}\"\n")
-ai_file.write("I will provide patches below with short text describing this patches. Please describe the patches as detailed as you can considering the short description. Use Markdown as output format. Patches must remain as it was.  Insert the generated description before patches. Use monospaced font for output. Use simple words for description.\n")
-
-try:
-    # delete temp branch in case it's already existed
-    repo.branches.delete("git-se/" + first_commit)
-except:
-    pass
-
-with open("{}/open-ai.token".format(SE_DIR), "r") as oai_file:
-    tok = oai_file.readline()
-    tok = tok.strip()
-    oai = OpenAI(api_key = tok)
-
-origin_ref = repo.head
-
-local_head = repo.revparse_single('HEAD').id
-last_commit_obj = repo.revparse_single(last_commit)
+        if key == curses.KEY_HOME:
+            pos = 0
 
-first_commit_obj = repo.revparse_single(first_commit)
-repo.branches.local.create("git-se/" + first_commit, first_commit_obj)
+        if key == curses.KEY_END:
+            pos = len(deltas) - 1
 
-d = repo.diff(first_commit_obj, last_commit_obj, flags=DiffOption.SHOW_BINARY)
+        if key == ord('g'):
+            pattern = prompt(box, "path: ")
+            if pattern:
+                pos = find_path(deltas, pattern, pos)
 
-repo.checkout("refs/heads/git-se/" + first_commit)
-repo.apply(d, location=ApplyLocation.BOTH)
+        if key == 32:
+            get_cfg(pos).select()
+            journal_select(pos, cfg[pos])
 
-index = repo.index
-author = pygit2.Signature('Git Se', 'gitse@gitse.se')
-committer = pygit2.Signature('Git Se', 'gitse@gitse.se')
-message = "Git Se auto generated commit"
-tree = index.write_tree()
-ref = repo.head.name
-parents = [repo.head.target]
-git_se_head = repo.create_commit(ref, author, committer, message, tree, parents)
+        if key == 10:
+            get_cfg(pos).select_ex(stdscr, matches.get(pos))
+            journal_select(pos, cfg[pos])
+            box.touchwin()
 
-sd = repo.diff(first_commit_obj, git_se_head, flags=DiffOption.SHOW_BINARY)
+        if key == ord('/'):
+            origin = pos
+            if read_query(stdscr, box, "/", search) is None:
+                matches = {}
+                last_query = ("", 0, False)
+                pos = origin
+
+        if key == ord('P') and deltas:
+            if hunk_index is None:
+                hunk_index = HunkIndex(repo.path, deltas, first_commit)
+            if wait_hunk_index(stdscr, hunk_index) and hunk_index.proposals:
+                proposal = 0 if proposal is None else (proposal + 1) % len(hunk_index.proposals)
+                propose(proposal)
+            else:
+                hunk_index = None
+            box.touchwin()
 
-wrapper(main, sd, repo, first_commit, git_se_head, local_head)
+        if key == ord('C') and commit_seeds:
+            # more original commits join the working set, the selection starts over
+            upto = pick_commits(stdscr, commit_seeds)
+            if upto is not None and upto > commit_seeds.at:
+                git_se_head = commit_seeds.seed(pygit2.Oid(hex=first_commit), upto)
+                journal_stage(first_commit, git_se_head, "seed")
+                reload()
+            box.touchwin()
 
-recreator_file.write("popd\n")
-recreator_file.close()
-ai_file.close()
+        if (key == ord('n') or key == ord('N')) and matches:
+            pos = next_match(pos, 1 if key == ord('n') else -1)
+
+        if key == ord('*') and matches:
+            # stage every matching line of the files which can be split
+            for i, rows in matches.items():
+                c = get_cfg(i)
+                if c.can_select_partially():
+                    c.select_rows(rows)
+                    journal_select(i, c)
+
+def plan_select(stage, repo, deltas, diff, logger, history_from):
+    # per-file state of a plan stage: `files` are paths or glob patterns of whole files,
+    # `hunks` and `lines` map a path to hunk numbers and [first, last] line ranges,
+    # `proposal` takes the proposed stage of that number (1-based) of the changes left
+    picked = {}
+
+    def delta_cfg(i):
+        if i not in picked:
+            picked[i] = DiffConfig(repo, diff, i, deltas[i], logger)
+        return picked[i]
+
+    def match(pattern):
+        found = [i for i, d in enumerate(deltas)
+                 if fnmatch.fnmatchcase(d.new_file.path, pattern) or fnmatch.fnmatchcase(d.old_file.path, pattern)]
+        if not found:
+            raise ValueError("no changes left in {}".format(pattern))
+        return found
+
+    if "proposal" in stage:
+        index = HunkIndex(repo.path, deltas, history_from)
+        index.done.wait()
+        if index.error:
+            raise ValueError("grouping hunks failed: {}".format(index.error))
+        n = stage["proposal"]
+        if n < 1 or n > len(index.proposals):
+            raise ValueError("no proposal {}, there are {}".format(n, len(index.proposals)))
+        for i, numbers in index.proposals[n - 1].items():
+            c = delta_cfg(i)
+            if numbers is None or not c.can_select_partially():
+                c.selected = True
+            else:
+                c.select_lines(numbers)
+
+    for pattern in stage.get("files", []):
+        for i in match(pattern):
+            delta_cfg(i).selected = True
+
+    partial = {}
+    for path, hunks in stage.get("hunks", {}).items():
+        partial.setdefault(path, ([], []))[0].extend(hunks)
+    for path, ranges in stage.get("lines", {}).items():
+        partial.setdefault(path, ([], []))[1].extend(ranges)
+
+    for path, (hunks, ranges) in partial.items():
+        for i in match(path):
+            c = delta_cfg(i)
+            if not c.can_select_partially():
+                raise ValueError("{} can not be selected partially".format(c.delta.new_file.path))
+            c.select_lines(hunks, ranges)
+            if not c.partially_selected:
+                raise ValueError("nothing selected in {}".format(c.delta.new_file.path))
+
+    if not picked:
+        raise ValueError("nothing selected")
+    return [picked[i] for i in sorted(picked)]
+
+
+def run_plan(stages, sd, repo, first_commit, git_se_head, local_head, skip=0):
+    # headless counterpart of `main`: every stage of the plan is selected, built and committed
+    # without a terminal, the first `skip` stages are already done. Prints timings per stage,
+    # returns True if the whole plan went through
+    logger = setup_logger()
+
+    logger.debug("git-se starting up in batch mode")
+    started = time.perf_counter()
+    done = 0
+
+    for n, stage in enumerate(stages[skip:], skip + 1):
+        timings = {}
+        t = time.perf_counter()
+        try:
+            stage_cfg = plan_select(stage, repo, list(sd.deltas), sd, logger, first_commit)
+        except (ValueError, TypeError) as e:
+            print("stage {}: {}".format(n, e), file=sys.stderr)
+            return False
+        timings["select"] = time.perf_counter() - t
+
+        # AI works while the stage is being built
+        message = stage.get("message", "").strip()
+        ai_job = None
+        if stage.get("ai") and ai_backend:
+            items = ai_patch_items(stage_cfg)
+            if len(items) > 0:
+                ai_job = AIJob(message, items, stage_digest(stage_cfg), logger, ai_cache)
+
+        t = time.perf_counter()
+        selected_patches, stage_tree, apply_errors, rest_index = build_stage(repo, stage_cfg, first_commit, git_se_head, logger)
+        failed = len(apply_errors) > 0
+        for path, err in apply_errors:
+            print("stage {}: {}: {}".format(n, path, err), file=sys.stderr)
+        if rest_index.conflicts is not None:
+            conflicts = index_conflicts(rest_index)
+            if stage.get("conflicts") == "theirs":
+                take_theirs(rest_index, conflicts)
+            else:
+                failed = True
+                for path, theirs in conflicts:
+                    print("stage {}: remaining changes conflict in {}".format(n, path), file=sys.stderr)
+        if failed:
+            if ai_job:
+                ai_job.cancel()
+            if not IN_MEMORY:
+                repo.reset(git_se_head, pygit2.GIT_RESET_HARD)
+            return False
+        timings["build"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        if ai_job:
+            ai_job.done.wait()
+            if ai_job.error:
+                print("stage {}: AI description failed: {}".format(n, ai_job.error), file=sys.stderr)
+            elif len(ai_job.text) > 0:
+                message += "\n\n" + ai_job.text
+        timings["ai"] = time.perf_counter() - t
+
+        t = time.perf_counter()
+        record_stage(stage_cfg, selected_patches, message)
+        new_git_se_head, git_se_head = commit_stage(repo, stage_tree, rest_index, first_commit, git_se_head, local_head, message + "\n")
+        record_replay(repo, new_git_se_head)
+        journal_stage(new_git_se_head, git_se_head)
+        timings["commit"] = time.perf_counter() - t
+        done += 1
+        if profiler:
+            profiler.flush(ai_chapter - 1)
+
+        print("stage {}: {} files, {}, {:.3f}s total".format(
+            n, len(stage_cfg), ", ".join("{} {:.3f}s".format(k, v) for k, v in timings.items()), sum(timings.values())))
+
+        if git_se_head is None:
+            if n < len(stages):
+                print("all changes are staged, {} stages left unused".format(len(stages) - n), file=sys.stderr)
+            break
 
-repo.checkout(origin_ref)
+        with profile("diff"):
+            sd.advance(new_git_se_head, git_se_head)
+        first_commit = str(new_git_se_head)
+        logger.debug("new head = {}".format(str(git_se_head)))
+
+    left = "" if git_se_head is None else ", {} files left on {}".format(len(sd), SE_REF)
+    print("{} stages in {:.3f}s{}".format(done, time.perf_counter() - started, left))
+    return True
+
+
+@contextlib.contextmanager
+def worktrees_locked(path):
+    # libgit2 reads the HEAD of every worktree when one is added, a worktree that another session
+    # is setting up at that moment makes the new branch look checked out. Sessions take turns
+    with locked("{}/worktrees.lock".format(os.path.dirname(os.path.dirname(path)))):
+        yield
+
+
+def drop_session_worktree(repo, name, path):
+    # the worktree of a named session goes away when the session ends or gets interrupted,
+    # its branch keeps the stages
+    shutil.rmtree(path, ignore_errors=True)
+    with worktrees_locked(path):
+        if name in repo.list_worktrees():
+            repo.lookup_worktree(name).prune(True)
+
+
+def session_worktree(repo, name, path):
+    # the branch of a named session is checked out in a linked worktree of its own,
+    # the user's checkout is not touched and other sessions can run next to it
+    with worktrees_locked(path):
+        repo.add_worktree(name, path, repo.references[SE_REF])
+    return pygit2.Repository(path)
+
+
+def run_sessions(sessions, common, jobs, se_root):
+    # headless sessions of several ranges at once, each one is a git-se process with `--session`.
+    # A session is {"name", "start", "end", "plan"}, the plan is a list of stages or a plan file.
+    # Prints a line per session, its output goes to its session directory. Returns True if all plans went through
+    def run(session):
+        session_dir = "{}/{}/{}".format(se_root, SESSIONS_DIR, session["name"])
+        pathlib.Path(session_dir).mkdir(parents=True, exist_ok=True)
+        plan = session["plan"]
+        if not isinstance(plan, str):
+            plan = "{}/plan.json".format(session_dir)
+            with open(plan, "w") as f:
+                json.dump(session["plan"], f)
+        started = time.perf_counter()
+        with open("{}/output.log".format(session_dir), "w") as output:
+            rc = subprocess.run([sys.executable, os.path.abspath(__file__), session["start"], "-e", session.get("end", "HEAD"),
+                                 "--session", session["name"], "--plan", plan] + common,
+                                stdout=output, stderr=subprocess.STDOUT).returncode
+        with open("{}/output.log".format(session_dir), "r", errors="replace") as output:
+            lines = output.read().splitlines()
+        return (rc, lines[-1] if lines else "", time.perf_counter() - started)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(run, sessions))
+    for session, (rc, last, seconds) in zip(sessions, results):
+        state = "done" if rc == 0 else "failed"
+        print("{}: {} in {:.3f}s: {}".format(session["name"], state, seconds, last))
+    return all(rc == 0 for rc, last, seconds in results)
+
+
+if __name__ == "__main__":
+    # parse command line options
+    parser = argparse.ArgumentParser(description='Git split-explain tool')
+    parser.add_argument('start commit', metavar='S', type=str, nargs='?',
+                        help='start commit (end commit will be HEAD)')
+    parser.add_argument('-e', metavar='E', type=str,
+                        help='end commits', default='HEAD')
+    parser.add_argument('-r', metavar='R', type=str, help='repository path', default='.')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='build stage commits from trees and blobs without touching the working tree and index')
+    parser.add_argument('--ai-backend', choices=['openai', 'local'], default='openai',
+                        help='service generating descriptions, `local` is an offline stand-in')
+    parser.add_argument('--no-ai', action='store_true', help='no generated descriptions, stages are described by hand only')
+    parser.add_argument('--ai-workers', metavar='N', type=int, default=AI_WORKERS,
+                        help='concurrent requests when a stage is described in parts')
+    parser.add_argument('--ai-token-budget', metavar='T', type=int, default=AI_TOKEN_BUDGET,
+                        help='maximal estimated tokens of one AI request, bigger stages are described in parts')
+    parser.add_argument('--no-ai-cache', action='store_true', help='do not use the cache of AI generated descriptions')
+    parser.add_argument('--ai-cache-size', metavar='MB', type=int, default=AI_CACHE_MAX_BYTES // (1024 * 1024),
+                        help='maximal size of the AI description cache')
+    parser.add_argument('--ai-cache-age', metavar='DAYS', type=int, default=AI_CACHE_MAX_AGE // (24 * 3600),
+                        help='drop cached AI descriptions older than this')
+    parser.add_argument('--profile', action='store_true',
+                        help='write wall time and retained memory blocks per phase of every stage to {}/{}'.format(SE_DIR, PROFILE_FILENAME))
+    parser.add_argument('--trace-lines', action='store_true', help='log every parsed and generated patch line')
+    parser.add_argument('--find-renames', metavar='PCT', type=int, nargs='?', const=50,
+                        help='detect renamed files at the given similarity (50%% if omitted)')
+    parser.add_argument('--find-copies', metavar='PCT', type=int, nargs='?', const=50,
+                        help='detect files copied from other changed files, implies --find-renames')
+    parser.add_argument('--rename-limit', metavar='N', type=int, default=RENAME_LIMIT,
+                        help='skip the inexact rename detection with more than N candidates (default: %(default)s)')
+    parser.add_argument('--per-commit', action='store_true',
+                        help='split the original commits of the range one by one instead of their squashed diff')
+    parser.add_argument('--plan', metavar='FILE', type=str,
+                        help='split without a terminal following the stages of a JSON plan file')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue the last session from {}/{}, its range and diff options are kept'.format(SE_DIR, JOURNAL_FILENAME))
+    parser.add_argument('--session', metavar='NAME', type=str,
+                        help='keep the session apart in {}/{}/NAME on the branch git-se/NAME, without --in-memory '
+                             'it works in a worktree of its own'.format(SE_DIR, SESSIONS_DIR))
+    parser.add_argument('--sessions', metavar='FILE', type=str,
+                        help='split several ranges at once, FILE is a JSON list of {"name", "start", "end", "plan"} sessions')
+    parser.add_argument('--jobs', metavar='N', type=int, default=os.cpu_count() or 1,
+                        help='sessions of --sessions running at once')
+    args = parser.parse_args()
+    if args.sessions:
+        if getattr(args, 'start commit') is not None or args.resume or args.plan or args.session:
+            parser.error("--sessions takes the ranges and plans from its file")
+    elif (getattr(args, 'start commit') is None) != args.resume:
+        parser.error("either the start commit or --resume is required")
+    if args.session and (not SESSION_NAME_RE.match(args.session) or args.session == "recreator"):
+        parser.error("invalid session name {}".format(args.session))
+
+    first_commit = getattr(args, 'start commit')
+    last_commit = args.e
+    repo_path = args.r
+    IN_MEMORY = args.in_memory
+    AI_WORKERS = max(args.ai_workers, 1)
+    AI_TOKEN_BUDGET = args.ai_token_budget
+    if AI_TOKEN_BUDGET < ai_min_token_budget():
+        sys.exit("git-se: --ai-token-budget must be at least {}, the prompts alone take most of that".format(ai_min_token_budget()))
+    TRACE_LINES = args.trace_lines
+    FIND_COPIES = args.find_copies
+    FIND_RENAMES = args.find_renames if args.find_renames is not None else FIND_COPIES
+    RENAME_LIMIT = args.rename_limit
+    PER_COMMIT = args.per_commit
+
+    plan_stages = None
+    if args.plan:
+        # read the plan before touching the repository
+        with open(args.plan, "r") as plan_file:
+            plan = json.load(plan_file)
+        plan_stages = plan["stages"] if isinstance(plan, dict) else plan
+
+
+    repo = pygit2.Repository(repo_path)
+
+    WORK_DIR = repo.workdir
+    SE_DIR = "{}/{}".format(repo.workdir, SE_DIR)
+
+    if args.sessions:
+        with open(args.sessions, "r") as sessions_file:
+            sessions = json.load(sessions_file)
+        names = [s.get("name", "") for s in sessions]
+        for name, s in zip(names, sessions):
+            if not SESSION_NAME_RE.match(name) or name == "recreator" or names.count(name) > 1:
+                sys.exit("git-se: invalid or repeated session name {!r}".format(name))
+            for field in ("start", "plan"):
+                if field not in s:
+                    sys.exit("git-se: session {} has no {!r}".format(name, field))
+        for s in sessions:
+            if isinstance(s["plan"], str):
+                s["plan"] = os.path.join(os.path.dirname(os.path.abspath(args.sessions)), s["plan"])
+        common = ["-r", os.path.abspath(repo_path), "--ai-backend", args.ai_backend, "--ai-workers", str(AI_WORKERS),
+                  "--ai-token-budget", str(AI_TOKEN_BUDGET), "--ai-cache-size", str(args.ai_cache_size),
+                  "--ai-cache-age", str(args.ai_cache_age), "--rename-limit", str(RENAME_LIMIT)]
+        for flag, on in (("--in-memory", IN_MEMORY), ("--no-ai", args.no_ai), ("--no-ai-cache", args.no_ai_cache),
+                         ("--per-commit", PER_COMMIT), ("--profile", args.profile), ("--trace-lines", TRACE_LINES)):
+            if on:
+                common.append(flag)
+        for flag, value in (("--find-renames", args.find_renames), ("--find-copies", args.find_copies)):
+            if value is not None:
+                common += [flag, str(value)]
+        sys.exit(0 if run_sessions(sessions, common, max(args.jobs, 1), SE_DIR) else 1)
+
+    # the AI token and cache are shared, everything else of a named session stays in its own directory
+    se_root = SE_DIR
+    if args.session:
+        SE_DIR = "{}/{}/{}".format(se_root, SESSIONS_DIR, args.session)
+    pathlib.Path(SE_DIR).mkdir(parents=True, exist_ok=True)
+
+    journal_path = "{}/{}".format(SE_DIR, JOURNAL_FILENAME)
+    output_paths = {"ai": "{}/{}".format(SE_DIR, AI_PROMPT_FILENAME),
+                    "recreator": "{}/git-se.recreator.sh".format(SE_DIR),
+                    "replay": "{}/{}".format(SE_DIR, REPLAY_FILENAME)}
+    session = None
+    selections = None
+    if args.resume:
+        try:
+            session, resume_at, selections, journal_size = resume_point(journal_path)
+        except (OSError, ValueError) as e:
+            sys.exit("git-se: {}".format(e))
+        first_commit = session["first_commit"]
+        last_commit = session["last_commit"]
+        IN_MEMORY = session["in_memory"]
+        FIND_RENAMES = session["find_renames"]
+        FIND_COPIES = session["find_copies"]
+        RENAME_LIMIT = session["rename_limit"]
+        PER_COMMIT = session.get("per_commit", False)
+        ai_chapter = resume_at["chapter"]
+    else:
+        # a tag, a branch or a short sha is resolved once, the stages, the branch names and the journal use the id
+        try:
+            first_commit = str(repo.revparse_single(first_commit).peel(pygit2.Commit).id)
+        except (KeyError, ValueError, pygit2.GitError):
+            sys.exit("git-se: unknown start commit {}".format(first_commit))
+
+    if args.profile:
+        profiler = Profiler("{}/{}".format(SE_DIR, PROFILE_FILENAME))
+
+    session_name = args.session or first_commit
+    recreator_branch = "git-se/{}/recreator".format(session_name)
+
+    # same session as a single fast-import stream, `git-se/<start>/recreator` can not live next to `git-se/<start>`
+    REPLAY_REF = "refs/heads/git-se/recreator/{}".format(session_name)
+    SE_REF = "refs/heads/git-se/" + session_name
+
+    # a named session works in a worktree of its own, one left over by an interrupted run is dropped
+    worktree_name = "git-se-" + session_name
+    worktree_path = "{}/{}".format(SE_DIR, SESSION_WORKTREE) if args.session and not IN_MEMORY else None
+    if worktree_path:
+        drop_session_worktree(repo, worktree_name, worktree_path)
+    user_repo = repo
+
+    if session:
+        # outputs go on after the last committed stage, whatever an unfinished one wrote is cut off
+        for name, path in output_paths.items():
+            os.truncate(path, resume_at["outputs"][name])
+        os.truncate(journal_path, journal_size)
+        ai_file = open(output_paths["ai"], "a", errors="surrogateescape")
+        recreator_file = open(output_paths["recreator"], "a")
+        replay_file = open(output_paths["replay"], "ab")
+        journal = Journal(journal_path)
+    else:
+        ai_file = open(output_paths["ai"], "w", errors="surrogateescape")
+        recreator_file = open(output_paths["recreator"], "w")
+        replay_file = open(output_paths["replay"], "wb")
+        journal = Journal(journal_path, "w")
+        replay_file.write("# replay with: git fast-import --force --quiet < {}/{}\n".format(SE_DIR, REPLAY_FILENAME).encode('utf-8'))
+        replay_file.write("reset {}\nfrom {}\n\n".format(REPLAY_REF, first_commit).encode('utf-8'))
+
+        recreator_file.write("#!/usr/bin/env bash\n\n")
+
+        recreator_file.write("RECREATOR_BRANCH=\"{}\"\n".format(recreator_branch))
+        recreator_file.write("if [ -n \"$1\" ]; then\n")
+        recreator_file.write("    RECREATOR_BRANCH=\"$1\"\n")
+        recreator_file.write("fi\n")
+        recreator_file.write(f"pushd {WORK_DIR}\n")
+        recreator_file.write("git branch -q -D \"${RECREATOR_BRANCH}\"\n")
+        recreator_file.write("git branch \"${{RECREATOR_BRANCH}}\" {}\n".format(first_commit))
+        recreator_file.write("git checkout \"${RECREATOR_BRANCH}\"\n")
+        ai_file.write("I will provide patches below with short text describing this patches. Please describe the patches as detailed as you can considering the short description. Use Markdown as output format. Patches must remain as it was.  Insert the generated description before patches. Use monospaced font for output. Use simple words for description.\n")
+
+        try:
+            # delete temp branch in case it's already existed
+            repo.branches.delete("git-se/" + session_name)
+        except:
+            pass
+
+    if args.no_ai:
+        ai_backend = None
+    elif args.ai_backend == 'local':
+        ai_backend = LocalBackend()
+    else:
+        ai_backend = OpenAIBackend("{}/open-ai.token".format(se_root))
+
+    if ai_backend and not args.no_ai_cache:
+        ai_cache = AICache("{}/{}".format(se_root, AI_CACHE_DIR), args.ai_cache_size * 1024 * 1024, args.ai_cache_age * 24 * 3600)
+
+    if session:
+        origin_ref = repo.references[session["origin"]]
+        local_head = pygit2.Oid(hex=session["local_head"])
+        stage_commit = resume_at["commit"]
+        git_se_head = pygit2.Oid(hex=resume_at["git_se_head"])
+        # an unfinished stage moves the branch and may leave the working tree half applied,
+        # both go back to the remaining changes of the last committed stage
+        on_se_ref = not repo.head_is_detached and repo.head.name == SE_REF
+        repo.references.create(SE_REF, git_se_head, force=True)
+        if worktree_path:
+            repo = session_worktree(repo, worktree_name, worktree_path)
+        elif not IN_MEMORY:
+            repo.checkout(SE_REF, strategy=pygit2.GIT_CHECKOUT_FORCE if on_se_ref else pygit2.GIT_CHECKOUT_SAFE)
+        first_commit_obj = repo.revparse_single(stage_commit)
+        if PER_COMMIT:
+            commit_seeds = CommitSeeds(repo, first_commit, last_commit)
+            commit_seeds.start, commit_seeds.at = resume_at["working_set"]
+    else:
+        origin_ref = repo.head
+
+        last_commit_obj = repo.revparse_single(last_commit)
+        # a resumed session keeps the range even if the end was a moving reference
+        last_commit = str(last_commit_obj.peel(pygit2.Commit).id)
+        # the split is done once the stages reach the end of the range
+        local_head = pygit2.Oid(hex=last_commit)
+
+        first_commit_obj = repo.revparse_single(first_commit)
+        if PER_COMMIT:
+            commit_seeds = CommitSeeds(repo, first_commit, last_commit)
+            if all(repo[c].tree_id == first_commit_obj.peel(pygit2.Commit).tree_id for c in commit_seeds.commits):
+                sys.exit("git-se: no changes between {} and {}".format(first_commit, args.e))
+        repo.branches.local.create("git-se/" + session_name, first_commit_obj)
+        if worktree_path:
+            repo = session_worktree(repo, worktree_name, worktree_path)
+            if commit_seeds:
+                commit_seeds.repo = repo
+
+        author = pygit2.Signature('Git Se', 'gitse@gitse.se')
+        committer = pygit2.Signature('Git Se', 'gitse@gitse.se')
+        message = "Git Se auto generated commit"
+
+        if commit_seeds:
+            # the first original commit with changes is all there is to split for now
+            if not IN_MEMORY:
+                repo.checkout(SE_REF)
+            git_se_head = commit_seeds.next(first_commit_obj.id)
+        elif IN_MEMORY:
+            # the squashed range is just the tree of the last commit on top of the first one
+            tree = last_commit_obj.peel(pygit2.Tree).id
+            git_se_head = repo.create_commit(SE_REF, author, committer, message, tree, [first_commit_obj.id])
+        else:
+            with profile("diff"):
+                d = repo.diff(first_commit_obj, last_commit_obj, flags=DiffOption.SHOW_BINARY)
 
-subprocess.Popen(["/usr/bin/env", "bash", "-c", "cat {}/{} | copyq copy -".format(SE_DIR, AI_PROMPT_FILENAME)])
+            with profile("apply"):
+                repo.checkout(SE_REF)
+                repo.apply(d, location=ApplyLocation.BOTH)
 
+            index = repo.index
+            tree = index.write_tree()
+            ref = repo.head.name
+            parents = [repo.head.target]
+            git_se_head = repo.create_commit(ref, author, committer, message, tree, parents)
+
+        stage_commit = first_commit
+        journal.write("start", first_commit=first_commit, last_commit=last_commit, local_head=str(local_head),
+                      origin=origin_ref.name, in_memory=IN_MEMORY, find_renames=FIND_RENAMES, find_copies=FIND_COPIES,
+                      rename_limit=RENAME_LIMIT, per_commit=PER_COMMIT, chapter=ai_chapter, commit=first_commit,
+                      git_se_head=str(git_se_head), outputs=output_offsets(),
+                      working_set=[commit_seeds.start, commit_seeds.at] if commit_seeds else None)
+
+    with profile("diff"):
+        sd = StageChanges(repo, first_commit_obj, git_se_head)
+    if profiler:
+        profiler.flush("startup")
+
+    try:
+        if args.plan:
+            plan_ok = run_plan(plan_stages, sd, repo, stage_commit, git_se_head, local_head, ai_chapter - 1)
+        else:
+            plan_ok = True
+            wrapper(main, sd, repo, stage_commit, git_se_head, local_head, selections)
+    except BaseException:
+        # the journal keeps the session, the user gets the checkout back
+        if worktree_path:
+            drop_session_worktree(user_repo, worktree_name, worktree_path)
+        elif not IN_MEMORY and not repo.head_is_detached and repo.head.name == SE_REF:
+            repo.checkout(origin_ref, strategy=pygit2.GIT_CHECKOUT_FORCE)
+        print("git-se: session interrupted, continue it with --resume{}".format(
+            " --session " + args.session if args.session else ""), file=sys.stderr)
+        raise
+    journal.close()
+
+    recreator_file.write("popd\n")
+    recreator_file.close()
+    replay_file.write(b"done\n")
+    replay_file.close()
+    if profiler:
+        profiler.close()
+    ai_file.close()
+
+    if ai_cache and (ai_cache.session["hits"] or ai_cache.session["misses"]):
+        print("AI cache: {} hits, {} misses ({} hits, {} misses, {} evictions in total)".format(
+            ai_cache.session["hits"], ai_cache.session["misses"], ai_cache.stats["hits"], ai_cache.stats["misses"], ai_cache.stats["evictions"]))
+
+    if worktree_path:
+        drop_session_worktree(user_repo, worktree_name, worktree_path)
+    elif not IN_MEMORY:
+        repo.checkout(origin_ref)
+
+    if args.plan:
+        sys.exit(0 if plan_ok else 1)
+
+    subprocess.Popen(["/usr/bin/env", "bash", "-c", "cat {}/{} | copyq copy -".format(SE_DIR, AI_PROMPT_FILENAME)])